@@ -0,0 +1,82 @@
+"""
+Peak memory traced while signing and verifying one token, per payload size.
+
+Run from the repository root:
+
+    python benchmarks/memory.py [--output results.json]
+
+``tracemalloc`` cannot count every allocation a call makes, only the memory
+alive at its peak and the blocks alive at the end. So the ``copies`` column,
+the peak divided by the size of the encoded payload, stands in for the
+allocation count: roughly how many copies of the payload were alive at
+once, which is what the intermediate copies cost. ``blocks`` is the number
+of memory blocks the call left allocated, its result included, from the
+snapshot statistics before and after.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ecdsa
+import jws
+
+SIZES = (1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024)
+
+# leave out what taking the snapshots allocates
+FILTERS = [tracemalloc.Filter(False, tracemalloc.__file__)]
+
+def traced(fn, *args):
+    # (peak bytes, blocks left allocated) for one call
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot().filter_traces(FILTERS)
+        tracemalloc.reset_peak()
+        result = fn(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        after = tracemalloc.take_snapshot().filter_traces(FILTERS)
+        blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+        del result
+        return (peak, blocks)
+    finally:
+        tracemalloc.stop()
+
+def measure(size, sk):
+    header = {'alg': 'ES256'}
+    payload = {'data': 'x' * size}
+    vk = sk.get_verifying_key()
+    encoded = len(jws.utils.encode(payload))
+    signature = jws.sign(header, payload, sk)
+    rows = [
+        ('sign', traced(jws.sign, header, payload, sk)),
+        ('verify', traced(jws.verify, header, payload, signature, vk)),
+    ]
+    if hasattr(jws, 'encode'):
+        token = jws.encode(header, payload, sk)
+        rows.append(('encode', traced(jws.encode, header, payload, sk)))
+        rows.append(('decode', traced(jws.decode, token, vk)))
+    return [{'op': op, 'payload_bytes': size, 'peak_bytes': peak, 'blocks': blocks,
+             'copies': round(float(peak) / encoded, 2)} for (op, (peak, blocks)) in rows]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+    sk = ecdsa.SigningKey.generate(ecdsa.NIST256p)
+    results = []
+    for size in SIZES:
+        for row in measure(size, sk):
+            results.append(row)
+            print('%(op)-7s %(payload_bytes)10d B  peak %(peak_bytes)12d B  copies %(copies)6.2f  '
+                  'blocks %(blocks)5d' % row)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
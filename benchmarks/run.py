@@ -0,0 +1,234 @@
+"""
+Throughput and latency of signing and verifying, per algorithm and payload size.
+
+Run from the repository root:
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --quick --compare results.json
+
+Every case is timed for ``--duration`` seconds (at least ``MIN_ITERATIONS``
+calls) and reported as ops/sec plus latency percentiles. Cases cover:
+
+* sign and verify for HS, RS, PS and ES at 256, 384 and 512 bits over
+  payloads from 100 B to 10 MB,
+* cold routing (route cache cleared before every call) against warm routing,
+* verifying with key objects against keys given as strings,
+* ES verify with cold keys against keys given to ``jws.algos.warm_up``,
+* ``jws.encode`` against a reused ``jws.SigningContext``,
+* the ``examples/minijwt.py`` round trip,
+* ``jws.utils.constant_time_compare`` next to the HMAC verify it serves.
+
+``--compare`` prints the ratio to a previous run's JSON and exits with status
+1 when a case got slower by more than ``--threshold``.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', 'examples'))
+
+import ecdsa
+import Crypto.PublicKey.RSA as RSA
+
+import jws
+import minijwt
+
+ALGORITHMS = ['%s%d' % (family, bits) for family in ('HS', 'RS', 'PS', 'ES') for bits in (256, 384, 512)]
+SIZES = (100, 1024, 10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024)
+QUICK_SIZES = (100, 10 * 1024)
+CURVES = {256: ecdsa.NIST256p, 384: ecdsa.NIST384p, 512: ecdsa.NIST521p}
+MIN_ITERATIONS = 3
+
+def make_keys():
+    """(signing key, verifying key) objects and string forms per algorithm family."""
+    rsa = RSA.generate(2048)
+    keys = {'HS': ('secret', 'secret', 'secret')}
+    keys['RS'] = keys['PS'] = (rsa, rsa.publickey(), rsa.publickey().exportKey())
+    for (bits, curve) in CURVES.items():
+        sk = ecdsa.SigningKey.generate(curve)
+        vk = sk.get_verifying_key()
+        keys['ES%d' % bits] = (sk, vk, vk.to_string())
+    return keys
+
+def keys_for(keys, alg):
+    return keys.get(alg[:2]) or keys[alg]
+
+def time_calls(fn, duration):
+    latencies = []
+    deadline = time.time() + duration
+    while len(latencies) < MIN_ITERATIONS or time.time() < deadline:
+        start = time.time()
+        fn()
+        latencies.append(time.time() - start)
+    return latencies
+
+def summarize(latencies):
+    ordered = sorted(latencies)
+    pick = lambda p: ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1e6
+    return {
+        'iterations': len(ordered),
+        'ops_per_sec': round(len(ordered) / sum(ordered), 2),
+        'p50_us': round(pick(0.50), 1),
+        'p90_us': round(pick(0.90), 1),
+        'p99_us': round(pick(0.99), 1),
+    }
+
+def run_case(name, fn, duration, **info):
+    result = {'name': name}
+    result.update(info)
+    try:
+        fn()
+        result.update(summarize(time_calls(fn, duration)))
+    except Exception as e:
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    return result
+
+def cases(keys, sizes, algorithms):
+    """Yield (name, fn, info) for every case."""
+    for alg in algorithms:
+        (sk, vk, vk_string) = keys_for(keys, alg)
+        header = {'alg': alg}
+        for size in sizes:
+            payload = {'data': 'x' * size}
+            sig = jws.sign(header, payload, sk)
+            info = {'alg': alg, 'payload_bytes': size, 'key': 'object', 'routing': 'warm'}
+            yield ('sign', lambda h=header, p=payload, k=sk: jws.sign(h, p, k), dict(info, op='sign'))
+            yield ('verify', lambda h=header, p=payload, s=sig, k=vk: jws.verify(h, p, s, k), dict(info, op='verify'))
+
+    # routing and key parsing, on a small payload so they are visible
+    payload = {'data': 'x' * 100}
+    for alg in ('HS256', 'ES256', 'RS256'):
+        if alg not in algorithms:
+            continue
+        (sk, vk, vk_string) = keys_for(keys, alg)
+        header = {'alg': alg}
+        sig = jws.sign(header, payload, sk)
+        info = {'alg': alg, 'payload_bytes': 100, 'op': 'verify'}
+        def cold(h=header, s=sig, k=vk):
+            jws.algos.clear_route_cache()
+            jws.verify(h, payload, s, k)
+        yield ('routing-cold', cold, dict(info, key='object', routing='cold'))
+        yield ('routing-warm', lambda h=header, s=sig, k=vk: jws.verify(h, payload, s, k),
+               dict(info, key='object', routing='warm'))
+        yield ('key-string', lambda h=header, s=sig, k=vk_string: jws.verify(h, payload, s, k),
+               dict(info, key='string', routing='warm'))
+        yield ('encode', lambda h=header, k=sk: jws.encode(h, payload, k), dict(info, op='sign', key='object'))
+        context = jws.SigningContext(header, sk)
+        yield ('context', lambda c=context: c.token(payload), dict(info, op='sign', key='object'))
+
+    # ES verify with a cold key against one given to jws.algos.warm_up, on a
+    # copy of the key so that the other cases stay cold
+    for bits in (256, 384, 512):
+        alg = 'ES%d' % bits
+        if alg not in algorithms:
+            continue
+        (sk, vk, _) = keys_for(keys, alg)
+        header = {'alg': alg}
+        sig = jws.sign(header, payload, sk)
+        warm = ecdsa.VerifyingKey.from_string(vk.to_string(), curve=vk.curve)
+        jws.algos.warm_up(warm)
+        info = {'alg': alg, 'payload_bytes': 100, 'op': 'verify', 'routing': 'warm'}
+        yield ('key-cold', lambda h=header, s=sig, k=vk: jws.verify(h, payload, s, k), dict(info, key='cold'))
+        yield ('key-warm', lambda h=header, s=sig, k=warm: jws.verify(h, payload, s, k), dict(info, key='warm'))
+
+    claim = {'iss': 'brianb', 'sub': 'benchmarks', 'exp': 2000000000}
+    for alg in ('HS256', 'ES256', 'RS256'):
+        if alg not in algorithms:
+            continue
+        (sk, vk, _) = keys_for(keys, alg)
+        def roundtrip(a=alg, sk=sk, vk=vk):
+            minijwt.from_jwt(minijwt.to_jwt(claim, a, sk), vk)
+        yield ('minijwt', roundtrip, {'alg': alg, 'op': 'roundtrip', 'payload_bytes': len(json.dumps(claim))})
+
+    # the digest comparison on its own, next to the HMAC verify that uses it
+    for bits in (256, 384, 512):
+        alg = 'HS%d' % bits
+        if alg not in algorithms:
+            continue
+        crypt = jws.algos.route(alg)
+        digest = crypt['sign'](b'message', 'secret')
+        # differs in the last byte only, the slowest case for a naive compare
+        other = digest[:-1] + (b'\x01' if digest[-1:] == b'\x00' else b'\x00')
+        yield ('compare', lambda a=digest, b=other: jws.utils.constant_time_compare(a, b),
+               {'alg': alg, 'op': 'compare', 'payload_bytes': len(digest)})
+        yield ('hmac-verify', lambda c=crypt, d=digest: c['verify'](b'message', d, 'secret'),
+               {'alg': alg, 'op': 'verify', 'payload_bytes': 7})
+
+def compare(results, baseline, threshold):
+    """Print ops/sec ratios against ``baseline``; return the regressed cases."""
+    key = lambda r: (r['name'], r.get('alg'), r.get('op'), r.get('payload_bytes'), r.get('key'), r.get('routing'))
+    before = dict((key(r), r) for r in baseline['results'] if 'ops_per_sec' in r)
+    regressions = []
+    for result in results:
+        old = before.get(key(result))
+        if old is None or 'ops_per_sec' not in result:
+            continue
+        ratio = result['ops_per_sec'] / old['ops_per_sec']
+        flag = ''
+        if ratio < 1 - threshold:
+            regressions.append(result)
+            flag = '  REGRESSION'
+        print('%-13s %-6s %-9s %9s B  %6.2fx%s' % (result['name'], result.get('alg', ''), result.get('op', ''),
+                                                 result.get('payload_bytes', ''), ratio, flag))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--quick', action='store_true', help='small payloads and short runs only')
+    parser.add_argument('--duration', type=float, help='seconds to time each case for')
+    parser.add_argument('--alg', action='append', help='only these algorithms (repeatable)')
+    parser.add_argument('--backend', default='default', help="algorithm backend, e.g. 'cryptography'")
+    parser.add_argument('--compare', help='JSON from an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown that counts as a regression when comparing (default 0.2)')
+    args = parser.parse_args(argv)
+
+    duration = args.duration or (0.05 if args.quick else 0.5)
+    sizes = QUICK_SIZES if args.quick else SIZES
+    algorithms = args.alg or ALGORITHMS
+    jws.algos.set_backend(args.backend)
+    keys = make_keys()
+
+    results = []
+    for (name, fn, info) in cases(keys, sizes, algorithms):
+        result = run_case(name, fn, duration, **info)
+        results.append(result)
+        if 'error' in result:
+            print('%-13s %-6s %-9s %9s B  error %s' % (name, info.get('alg', ''), info.get('op', ''),
+                                                       info.get('payload_bytes', ''), result['error']))
+        else:
+            print('%-13s %-6s %-9s %9s B  %12.1f ops/s  p50 %10.1f us  p99 %10.1f us' % (
+                name, info.get('alg', ''), info.get('op', ''), info.get('payload_bytes', ''),
+                result['ops_per_sec'], result['p50_us'], result['p99_us']))
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'quick': args.quick,
+            'duration': duration,
+            'backend': args.backend,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
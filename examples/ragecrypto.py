@@ -1,5 +1,6 @@
 import jws
 from jws.algos import AlgorithmBase, SignatureError
+from jws.utils import to_bytes_2and3
 
 class FXUY(AlgorithmBase):
     # initializer gets variables from algo router
@@ -8,9 +9,10 @@ class FXUY(AlgorithmBase):
         self.x = len(fval)
         self.y = len(uval)
 
-    # straightforward, just return the signature
+    # straightforward, just return the signature.
+    # ``msg`` is the signing input as bytes.
     def sign(self, msg, key):
-        return 'srs' * self.x + key + 'bzns' * self.y + msg
+        return b'srs' * self.x + to_bytes_2and3(key) + b'bzns' * self.y + msg
  
     # verify should only return if the signature is valid.
     # otherwise raise a SignatureError
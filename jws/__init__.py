@@ -1,56 +1,273 @@
 from __future__ import absolute_import
 
-import json
+import copy
+from collections import namedtuple
 
 import jws.utils as utils
 
 # local
 import jws.algos as algos
 import jws.header as header
+import jws.metrics as metrics
+from jws.cache import VerificationCache
+from jws.context import SigningContext
 from jws.exceptions import *
+from jws.keyring import KeyRing
+from jws.keys import KeyStore
+from jws.multi import sign_multi, verify_multi
+from jws.parallel import Verifier
+from jws.policy import Policy
+from jws.stream import Signer, sign_detached, verify_detached
 
 ##############
 # public api #
 ##############
-def sign(head, payload, key=None, is_json=False):
-    data = {
-        'key': key,
-        'header': json.loads(head) if is_json else head,
-        'payload': json.loads(payload) if is_json else payload,
-        'signer': None
-    }
-    # TODO: re-evaluate whether to pass ``data`` by reference, or to copy and reassign
-    header.process(data, 'sign')
-    if not data['key']:
-        raise MissingKey("Key was not passed as a param and a key could not be found from the header")
-    if not data['signer']:
-        raise MissingSigner("Header was processed, but no algorithm was found to sign the message")
-    signer = data['signer']
-    signature = signer(_signing_input(head, payload, is_json), key)
-    return utils.to_base64(signature)
+def sign(head, payload, key=None, is_json=False, codec=None, keystore=None):
+    with metrics.probe('sign') as probe:
+        probe.describe(head)
+        with probe.stage('header'):
+            data = _process(head, payload, key, 'sign', is_json, codec=codec, keystore=keystore)
+        probe.describe(data['header'])
+        with probe.stage('encode'):
+            signing_input = _signing_input(head, payload, is_json, codec)
+        with probe.stage('crypto'):
+            signature = data['signer'](signing_input, data['key'])
+        with probe.stage('encode'):
+            return utils.to_base64(signature)
+
+
+def verify(head, payload, encoded_signature, key=None, is_json=False, codec=None, keystore=None, cache=None):
+    with metrics.probe('verify') as probe:
+        probe.describe(head)
+        with probe.stage('header'):
+            data = _process(head, payload, key, 'verify', is_json, codec=codec, keystore=keystore)
+        probe.describe(data['header'])
+        with probe.stage('encode'):
+            signing_input = _signing_input(head, payload, is_json, codec)
+        with probe.stage('crypto'):
+            return _verify(data, signing_input, encoded_signature, cache)
+
+
+def encode(head, payload, key=None, codec=None, keystore=None):
+    """
+    Sign ``payload`` and return the compact ``header.payload.signature``
+    token. Each segment is serialized exactly once.
+    """
+    with metrics.probe('encode') as probe:
+        probe.describe(head)
+        with probe.stage('header'):
+            data = _process(head, payload, key, 'sign', keystore=keystore)
+        with probe.stage('encode'):
+            (head_input, payload_input) = (utils.encode(head, codec), utils.encode(payload, codec))
+        with probe.stage('crypto'):
+            signature = data['signer'](b'.'.join((head_input, payload_input)), data['key'])
+        with probe.stage('encode'):
+            return _text(b'.'.join((head_input, payload_input, utils.to_base64(signature))))
+
+
+def decode(token, key=None, codec=None, keystore=None, cache=None, policy=None):
+    """
+    Verify a compact token and return its ``(header, payload)``. The signature
+    is checked against the segments exactly as they were received.
+
+    A ``Policy`` given as ``policy`` checks the token before the signature.
+    """
+    with metrics.probe('decode') as probe:
+        if policy is not None:
+            with probe.stage('policy'):
+                policy.check_size(token)
+        with probe.stage('split'):
+            (signing_input, head_input, payload_input, encoded_signature) = _split(token)
+        if policy is not None:
+            with probe.stage('policy'):
+                policy.check_segments(signing_input, head_input, payload_input, encoded_signature)
+        with probe.stage('decode'):
+            head = utils.decode(head_input, codec)
+        probe.describe(head)
+        if policy is not None:
+            with probe.stage('policy'):
+                policy.check_header(head)
+        with probe.stage('decode'):
+            payload = utils.decode(payload_input, codec)
+        if policy is not None:
+            with probe.stage('policy'):
+                policy.check_claims(payload)
+        with probe.stage('header'):
+            data = _process(head, payload, key, 'verify', keystore=keystore, segment=head_input.tobytes())
+        with probe.stage('crypto'):
+            _verify(data, signing_input, encoded_signature, cache)
+        return (head, payload)
+
+
+class Result(namedtuple('Result', 'header payload value error')):
+    """
+    Outcome of one item of a batch. ``value`` is the verifier's return value
+    (``verify_many``) or the compact token (``sign_many``); ``error`` is the
+    exception raised for the item, or None.
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def verify_many(tokens, key_or_resolver=None, codec=None, policy=None):
+    """
+    Verify an iterable of compact ``header.payload.signature`` tokens, yielding
+    a ``Result`` per token in input order. Errors are reported on the result
+    rather than raised, so one bad token never stops the batch.
 
+    ``key_or_resolver`` is either the key for every token or a callable that
+    takes the decoded header and returns the key, such as a ``KeyStore``.
+    Tokens sharing a header segment form a group: the header is processed,
+    the algorithm routed and the key resolved and parsed once per group.
 
-def verify(head, payload, encoded_signature, key=None, is_json=False):
+    A ``Policy`` given as ``policy`` checks each token before its signature.
+    """
+    groups = utils.LRUCache(BATCH_GROUPS)
+    for token in tokens:
+        head = payload = None
+        try:
+            if policy is not None:
+                policy.check_size(token)
+            (signing_input, head_input, payload_input, encoded_signature) = _split(token)
+            if policy is not None:
+                policy.check_segments(signing_input, head_input, payload_input, encoded_signature)
+            head_input = head_input.tobytes()
+            group = groups.get(head_input)
+            if group is None:
+                group = _group(head_input, key_or_resolver, 'verify', codec, policy)
+                groups.put(head_input, group)
+            if isinstance(group, TokenRejected):
+                # counted for every token, though checked once per group
+                policy.reject(_fresh(group))
+            if isinstance(group, Exception):
+                raise _fresh(group)
+            (head, verifier, key) = group
+            payload = utils.decode(payload_input, codec)
+            if policy is not None:
+                policy.check_claims(payload)
+            signature = utils.from_base64(encoded_signature)
+            value = verifier(signing_input, signature, key)
+            yield Result(head, payload, value, None)
+        except Exception as e:
+            yield Result(head, payload, None, e)
+
+
+def sign_many(items, key_or_resolver=None, codec=None):
+    """
+    Sign an iterable of ``(header, payload)`` pairs, yielding a ``Result`` per
+    item in input order whose ``value`` is the compact token. Items sharing a
+    header are grouped the same way as in ``verify_many``.
+    """
+    groups = utils.LRUCache(BATCH_GROUPS)
+    for (head, payload) in items:
+        try:
+            head_input = utils.encode(head, codec)
+            group = groups.get(head_input)
+            if group is None:
+                group = _group(head_input, key_or_resolver, 'sign', codec)
+                groups.put(head_input, group)
+            if isinstance(group, Exception):
+                raise _fresh(group)
+            (_, signer, key) = group
+            token = _text(_compact(head_input, utils.encode(payload, codec), signer, key))
+            yield Result(head, payload, token, None)
+        except Exception as e:
+            yield Result(head, payload, None, e)
+
+# how many distinct header segments a batch call remembers at once
+BATCH_GROUPS = 64
+
+####################
+# semi-private api #
+####################
+def _signing_input(head, payload, is_json=False, codec=None):
+    # algorithms are handed the signing input as bytes
+    if is_json:
+        return b'.'.join((utils.to_base64(head), utils.to_base64(payload)))
+    return b'.'.join((utils.encode(head, codec), utils.encode(payload, codec)))
+
+# where ``header.process`` leaves the method for each step
+STEPS = {'sign': 'signer', 'verify': 'verifier'}
+
+def _process(head, payload, key, step, is_json=False, unencoded=False, codec=None, keystore=None, segment=None):
     data = {
         'key': key,
-        'header': json.loads(head) if is_json else head,
-        'payload': json.loads(payload) if is_json else payload,
-        'verifier': None
+        'keystore': keystore,
+        'header': utils.from_json(head, codec) if is_json else head,
+        'payload': utils.from_json(payload, codec) if is_json else payload,
+        STEPS[step]: None
     }
     # TODO: re-evaluate whether to pass ``data`` by reference, or to copy and reassign
-    header.process(data, 'verify')
+    header.process(data, step, segment)
     if not data['key']:
         raise MissingKey("Key was not passed as a param and a key could not be found from the header")
-    if not data['verifier']:
-        raise MissingVerifier("Header was processed, but no algorithm was found to sign the message")
-    verifier = data['verifier']
-    signature = utils.from_base64(encoded_signature)
-    return verifier(_signing_input(head, payload, is_json), signature, key)
+    if not data[STEPS[step]]:
+        error = MissingSigner if step == 'sign' else MissingVerifier
+        raise error("Header was processed, but no algorithm was found to %s the message" % step)
+    if data.get('b64') is False and not unencoded:
+        raise ParameterNotImplemented("Unencoded payloads (b64: false) need jws.Signer or jws.verify_detached")
+    return data
 
-####################
-# semi-private api #
-####################
-def _signing_input(head, payload, is_json=False):
-    enc = utils.to_base64 if is_json else utils.encode
-    head_input, payload_input = map(enc, [head, payload])
-    return "%s.%s" % (head_input, payload_input)
+def _verify(data, signing_input, encoded_signature, cache=None):
+    # a ``VerificationCache`` hit stands in for the signature check
+    if cache is not None:
+        value = cache.get(signing_input, encoded_signature, data['key'])
+        if value is not None:
+            return value
+    value = data['verifier'](signing_input, utils.from_base64(encoded_signature), data['key'])
+    if cache is not None:
+        cache.put(signing_input, encoded_signature, data['key'], value, data['payload'])
+    return value
+
+def _group(head_input, key_or_resolver, step, codec=None, policy=None):
+    # everything a batch needs for tokens sharing one header segment, or the
+    # exception that makes every one of them fail
+    try:
+        head = utils.decode(head_input, codec)
+        if policy is not None:
+            error = policy.header_error(head)
+            if error is not None:
+                return error
+        key = key_or_resolver(head) if callable(key_or_resolver) else key_or_resolver
+        data = _process(head, None, key, step, segment=head_input)
+        prepare = (data.get('algorithm') or {}).get('prepare_key')
+        key = prepare(data['key']) if prepare else data['key']
+        return (head, data[STEPS[step]], key)
+    except Exception as e:
+        return e
+
+def _fresh(error):
+    # a copy of a group's exception for one item. Raising the cached instance
+    # itself would grow its traceback with every item and share it between
+    # all their results.
+    return copy.copy(error)
+
+def _compact(head_input, payload_input, signer, key):
+    signature = utils.to_base64(signer(b'.'.join((head_input, payload_input)), key))
+    return b'.'.join((head_input, payload_input, signature))
+
+def _split(token):
+    # (signing input, header, payload, signature) of a compact token. The
+    # signing input is sliced from the token once, and the header and payload
+    # are memoryviews into it rather than further copies.
+    if isinstance(token, utils.text_type):
+        token = token.encode('ascii')
+    elif not isinstance(token, utils.binary_type):
+        token = bytes(token)
+    end = token.rfind(b'.')
+    dot = token.find(b'.', 0, max(end, 0))
+    if dot < 0 or token.find(b'.', dot + 1, end) >= 0:
+        raise ValueError("Compact serialization must have three segments")
+    signing_input = token[:end]
+    encoded_signature = token[end + 1:]
+    view = memoryview(signing_input)
+    return (signing_input, view[:dot], view[dot + 1:], encoded_signature)
+
+def _text(segment):
+    # base64url is ascii, so this never changes the content
+    if isinstance(segment, utils.binary_type):
+        return segment.decode('ascii')
+    return segment
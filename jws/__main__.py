@@ -0,0 +1,5 @@
+import sys
+
+from jws.cli import main
+
+sys.exit(main())
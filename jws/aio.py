@@ -0,0 +1,146 @@
+"""
+asyncio versions of the public api (Python 3 only).
+
+Cheap work stays on the event loop: header processing, JSON and base64, and
+HMAC over inputs shorter than ``INLINE_THRESHOLD`` bytes. RSA and ECDSA, and
+HMAC over longer inputs, run on ``executor`` -- per call, else ``EXECUTOR``,
+else the loop's default thread pool. Work handed to a process pool is a
+module-level function with plain arguments, so it pickles; ``Crypto`` and
+``cryptography`` keys, which do not, go as their DER export and are parsed
+once per worker.
+
+Concurrent ``verify`` or ``decode`` calls for the identical token and key
+share one computation.
+"""
+import asyncio
+import copy
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import jws
+import jws.algos as algos
+import jws.utils as utils
+from jws.parallel import _DER, _portable
+
+# executor used when a call does not name one; None is the loop's default
+EXECUTOR = None
+# HMAC over a signing input shorter than this is done on the event loop
+INLINE_THRESHOLD = 16 * 1024
+# tokens per task in verify_many
+CHUNK_SIZE = 64
+
+_inflight = {}
+_PORTABLE = utils.LRUCache(64)
+
+async def sign(head, payload, key=None, executor=None, is_json=False, codec=None, keystore=None):
+    """Awaitable ``jws.sign``."""
+    data = jws._process(head, payload, key, 'sign', is_json, codec=codec, keystore=keystore)
+    signing_input = jws._signing_input(head, payload, is_json, codec)
+    signature = await _run(executor, _alg(data), signing_input, _sign_input, data['key'])
+    return utils.to_base64(signature)
+
+async def verify(head, payload, encoded_signature, key=None, executor=None, is_json=False, codec=None,
+                 keystore=None, cache=None):
+    """Awaitable ``jws.verify``."""
+    data = jws._process(head, payload, key, 'verify', is_json, codec=codec, keystore=keystore)
+    signing_input = jws._signing_input(head, payload, is_json, codec)
+    if cache is not None:
+        value = cache.get(signing_input, encoded_signature, data['key'])
+        if value is not None:
+            return value
+    signature = utils.from_base64(encoded_signature)
+    value = await _coalesce((signing_input, signature, id(data['key'])),
+                            lambda: _run(executor, _alg(data), signing_input, _verify_input, signature, data['key']))
+    if cache is not None:
+        cache.put(signing_input, encoded_signature, data['key'], value, data['payload'])
+    return value
+
+async def decode(token, key=None, executor=None, codec=None, keystore=None, cache=None, policy=None):
+    """Awaitable ``jws.decode``."""
+    if policy is not None:
+        policy.check_size(token)
+    (signing_input, head_input, payload_input, encoded_signature) = jws._split(token)
+    if policy is not None:
+        # checked for every call, though the waiters share the rest
+        policy.check_segments(signing_input, head_input, payload_input, encoded_signature)
+        policy.check_header(utils.decode(head_input, codec))
+        policy.check_claims(utils.decode(payload_input, codec))
+    async def compute():
+        head = utils.decode(head_input, codec)
+        payload = utils.decode(payload_input, codec)
+        data = jws._process(head, payload, key, 'verify', keystore=keystore)
+        if cache is not None and cache.get(signing_input, encoded_signature, data['key']) is not None:
+            return (head, payload)
+        signature = utils.from_base64(encoded_signature)
+        value = await _run(executor, _alg(data), signing_input, _verify_input, signature, data['key'])
+        if cache is not None:
+            cache.put(signing_input, encoded_signature, data['key'], value, payload)
+        return (head, payload)
+    (head, payload) = await _coalesce((signing_input, encoded_signature, id(key), id(keystore), id(cache)), compute)
+    # waiters share the result, so each gets its own copies
+    return (copy.copy(head), copy.copy(payload))
+
+async def verify_many(tokens, key_or_resolver=None, executor=None, chunk_size=None):
+    """
+    Awaitable ``jws.verify_many``, returning the list of ``jws.Result``. The
+    tokens are verified in chunks of ``chunk_size`` on the executor.
+    """
+    loop = asyncio.get_running_loop()
+    tokens = iter(tokens)
+    tasks = []
+    while True:
+        chunk = list(islice(tokens, chunk_size or CHUNK_SIZE))
+        if not chunk:
+            break
+        call = functools.partial(_verify_chunk, chunk, key_or_resolver)
+        tasks.append(loop.run_in_executor(executor or EXECUTOR, call))
+    results = []
+    for chunk in await asyncio.gather(*tasks):
+        results.extend(chunk)
+    return results
+
+async def _run(executor, alg, signing_input, fn, *args):
+    if alg.startswith('HS') and len(signing_input) < INLINE_THRESHOLD:
+        return fn(alg, signing_input, *args)
+    executor = executor or EXECUTOR
+    if isinstance(executor, ProcessPoolExecutor):
+        # the key is the last argument
+        args = args[:-1] + (_portable_key(args[-1]),)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(fn, alg, signing_input, *args))
+
+def _portable_key(key):
+    # what a process pool is given for ``key``, remembered by id(key); the
+    # key is kept alongside so the id is not reused
+    known = _PORTABLE.get(id(key))
+    if known is None or known[0] is not key:
+        known = (key, _portable(key))
+        _PORTABLE.put(id(key), known)
+    return known[1]
+
+async def _coalesce(key, compute):
+    key = (id(asyncio.get_running_loop()),) + key
+    future = _inflight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(compute())
+        _inflight[key] = future
+        future.add_done_callback(lambda done: _inflight.pop(key, None))
+    # one waiter being cancelled must not cancel the work for the others
+    return await asyncio.shield(future)
+
+def _alg(data):
+    return data['header'].get('alg', '')
+
+def _sign_input(alg, signing_input, key):
+    if isinstance(key, _DER):
+        key = key.load()
+    return algos.route(alg)['sign'](signing_input, key)
+
+def _verify_input(alg, signing_input, signature, key):
+    if isinstance(key, _DER):
+        key = key.load()
+    return algos.route(alg)['verify'](signing_input, signature, key)
+
+def _verify_chunk(tokens, key_or_resolver):
+    return list(jws.verify_many(tokens, key_or_resolver))
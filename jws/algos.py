@@ -1,10 +1,12 @@
 from __future__ import absolute_import
 
+import hashlib
+import hmac
 import sys
 import re
 
 from .exceptions import SignatureError, RouteMissingError, RouteEndpointError
-from .utils import to_bytes_2and3, constant_time_compare
+from .utils import to_bytes_2and3, constant_time_compare, LRUCache, binary_type, text_type
 
 class AlgorithmBase(object):
     """Base for algorithm support classes."""
@@ -26,27 +28,77 @@ class HasherBase(AlgorithmBase):
             raise NotImplementedError("%s implements %s bit algorithms (given %d)" %
                                       (self.__class__, ', '.join(self.supported_bits), self.bits))
         if not getattr(self, 'hasher', None):
-            import hashlib
             self.hasher = getattr(hashlib, 'sha%d' % self.bits)
 
 class HMAC(HasherBase):
     """
-    Support for HMAC signing.
+    Support for HMAC signing. Keys are secrets as text or bytes, or
+    ``HMACKey`` objects.
     """
+    def prepare_key(self, key):
+        """
+        Turn a secret into an ``HMACKey`` for this hash size, so the hmac is
+        keyed once for many messages.
+        """
+        if isinstance(key, HMACKey) and key.bits == self.bits:
+            return key
+        return HMACKey(key, self.bits)
+
     def sign(self, msg, key):
-        import hmac
-        if sys.version < '3':
-            utfkey = unicode(key).encode('utf8')
-        else:
-            utfkey = to_bytes_2and3(key)
-            msg = to_bytes_2and3(msg)
-        return hmac.new(utfkey, msg, self.hasher).digest()
+        if isinstance(key, HMACKey) and key.bits == self.bits:
+            return key.new(to_bytes_2and3(msg)).digest()
+        return hmac.new(secret_bytes(key), to_bytes_2and3(msg), self.hasher).digest()
 
     def verify(self, msg, crypto, key):
         if not constant_time_compare(self.sign(msg, key), crypto):
             raise SignatureError("Could not validate signature")
         return True
 
+    def new_hash(self, key):
+        return self.prepare_key(key).new()
+
+    def sign_hash(self, hashm, key):
+        return hashm.digest()
+
+    def verify_hash(self, hashm, crypto, key):
+        if not constant_time_compare(hashm.digest(), crypto):
+            raise SignatureError("Could not validate signature")
+        return True
+
+class HMACKey(object):
+    """
+    An HMAC secret keyed once for one hash size (256, 384 or 512). Signing
+    and verifying copy the prepared hmac state instead of deriving the inner
+    and outer key blocks from the secret again. Use it anywhere the secret
+    itself is accepted; with an ``alg`` of another size the secret is used.
+    """
+    def __init__(self, secret, bits):
+        if isinstance(secret, HMACKey):
+            secret = secret.secret
+        self.secret = secret_bytes(secret)
+        self.bits = int(bits)
+        self._hmac = hmac.new(self.secret, digestmod=getattr(hashlib, 'sha%d' % self.bits))
+
+    def new(self, msg=None):
+        """A fresh hmac object, already fed ``msg`` if given."""
+        hashm = self._hmac.copy()
+        if msg is not None:
+            hashm.update(msg)
+        return hashm
+
+    def __reduce__(self):
+        return (HMACKey, (self.secret, self.bits))
+
+def secret_bytes(key):
+    """The bytes of an HMAC secret given as text, bytes or an ``HMACKey``."""
+    if isinstance(key, HMACKey):
+        return key.secret
+    if isinstance(key, binary_type):
+        return key
+    if sys.version < '3':
+        return unicode(key).encode('utf8')
+    return to_bytes_2and3(key)
+
 class RSABase(HasherBase):
     """
     Support for RSA signing.
@@ -58,20 +110,28 @@ class RSABase(HasherBase):
 
     def __init__(self, padder, bits):
         super(RSABase,self).__init__(bits)
+        import Crypto.PublicKey.RSA as RSA
         self.padder = padder
-        from Crypto.Hash import SHA256,SHA384,SHA512
-        self.hashm = __import__('Crypto.Hash.SHA%d'%self.bits, globals(), locals(), ['*']).new()
+        self.import_key = RSA.importKey
+        # instances are shared between calls and threads, so only the hash
+        # module is kept here and every message gets a fresh hash from it
+        self.hashmod = __import__('Crypto.Hash.SHA%d' % self.bits, globals(), locals(), ['new'])
+
+    def prepare_key(self, key):
+        """
+        Parse a PEM or DER ``key`` with ``RSA.importKey``, going through
+        ``KEY_CACHE``. Key objects are passed through untouched.
+        """
+        if isinstance(key, (binary_type, text_type)):
+            key = cached_key(key, 'RSA', self.import_key)
+        return key
 
     def sign(self, msg, key):
         """
         Signs a message with an RSA PrivateKey and hash method
         """
-        import Crypto.PublicKey.RSA as RSA
-
-        self.hashm.update(msg.encode('UTF-8'))
-        ## assume we are dealing with a real key
-        # private_key = RSA.importKey(key)
-        return self.padder.new(key).sign(self.hashm)             # pycrypto 2.5
+        hashm = self.hashmod.new(to_bytes_2and3(msg))
+        return self.padder.new(self.prepare_key(key)).sign(hashm)             # pycrypto 2.5
 
     def verify(self, msg, crypto, key):
         """
@@ -80,13 +140,20 @@ class RSABase(HasherBase):
         ``crypto`` is the cryptographic signature
         ``key`` is the verifying key. Can be a real key object or a string.
         """
-        import Crypto.PublicKey.RSA as RSA
+        hashm = self.hashmod.new(to_bytes_2and3(msg))
+        private_key = self.prepare_key(key)
+        if not self.padder.new( private_key ).verify(hashm,  crypto):  #:pycrypto 2.5
+            raise SignatureError("Could not validate signature")
+        return True
+
+    def new_hash(self, key):
+        return self.hashmod.new()
+
+    def sign_hash(self, hashm, key):
+        return self.padder.new(self.prepare_key(key)).sign(hashm)
 
-        self.hashm.update(msg.encode('UTF-8'))
-        private_key = key
-        if not isinstance(key, RSA._RSAobj):
-            private_key = RSA.importKey(key)
-        if not self.padder.new( private_key ).verify(self.hashm,  crypto):  #:pycrypto 2.5
+    def verify_hash(self, hashm, crypto, key):
+        if not self.padder.new(self.prepare_key(key)).verify(hashm, crypto):
             raise SignatureError("Could not validate signature")
         return True
 
@@ -112,12 +179,36 @@ class ECDSA(HasherBase):
         384: 'NIST384p',
         512: 'NIST521p',
     }
+    def __init__(self, bits):
+        super(ECDSA, self).__init__(bits)
+        import ecdsa
+        self.ecdsa = ecdsa
+        self.curve = getattr(ecdsa, self.bits_to_curve[self.bits])
+
+    def prepare_key(self, key, warm=False):
+        """
+        Parse a raw verifying key string for the curve matching the bit depth
+        of the algorithm, going through ``KEY_CACHE``. A key given to
+        ``warm_up`` earlier is swapped for its warmed copy, and with ``warm``
+        the key is warmed up now; other key objects are passed through
+        untouched.
+        """
+        if isinstance(key, (binary_type, text_type)):
+            parse = lambda material: self.ecdsa.VerifyingKey.from_string(material, curve=self.curve)
+            key = cached_key(to_bytes_2and3(key), self.curve.name, parse)
+        if warm:
+            return warm_up(key)
+        if WARM_KEYS:
+            warm = WARM_KEYS.get(id(key))
+            if warm is not None and warm[0] is key:
+                return warm[1]
+        return key
+
     def sign(self, msg, key):
         """
         Signs a message with an ECDSA SigningKey and hash method matching the
         bit depth of curve algorithm.
         """
-        import ecdsa
         ##  assume the signing key is already a real key
         # curve = getattr(ecdsa, self.bits_to_curve[self.bits])
         # signing_key = ecdsa.SigningKey.from_string(key, curve=curve)
@@ -131,28 +222,155 @@ class ECDSA(HasherBase):
         ``crypto`` is the cryptographic signature
         ``key`` is the verifying key. Can be a real key object or a string.
         """
-        import ecdsa
-        curve = getattr(ecdsa, self.bits_to_curve[self.bits])
-        vk = key
-        if not isinstance(vk, ecdsa.VerifyingKey):
-            vk = ecdsa.VerifyingKey.from_string(key, curve=curve)
+        vk = self.prepare_key(key)
         try:
             vk.verify(crypto, to_bytes_2and3(msg), hashfunc=self.hasher)
-        except ecdsa.BadSignatureError:
+        except self.ecdsa.BadSignatureError:
             raise SignatureError("Could not validate signature")
         except AssertionError:
             raise SignatureError("Could not validate signature")
         return True
 
+    def new_hash(self, key):
+        return self.hasher()
+
+    def sign_hash(self, hashm, key):
+        return key.sign_digest(hashm.digest())
+
+    def verify_hash(self, hashm, crypto, key):
+        vk = self.prepare_key(key)
+        try:
+            vk.verify_digest(crypto, hashm.digest())
+        except self.ecdsa.BadSignatureError:
+            raise SignatureError("Could not validate signature")
+        except AssertionError:
+            raise SignatureError("Could not validate signature")
+        return True
+
+# parsed keys by digest of their material and the kind of key (``'RSA'`` or
+# the curve name). Resize by setting ``KEY_CACHE.maxsize``; ``KEY_CACHE.hits``
+# and ``KEY_CACHE.misses`` count lookups.
+KEY_CACHE_SIZE = 128
+KEY_CACHE = LRUCache(KEY_CACHE_SIZE)
+
+def cached_key(material, kind, parse):
+    """
+    Return ``parse(material)``, reusing the result of an earlier call for the
+    same material and ``kind``.
+    """
+    cache_key = (kind, hashlib.sha256(to_bytes_2and3(material)).digest())
+    key = KEY_CACHE.get(cache_key)
+    if key is None:
+        key = parse(material)
+        KEY_CACHE.put(cache_key, key)
+    return key
+
+# warmed copies of ``ecdsa`` verifying keys by id of the key they were made
+# from, which is kept next to its copy so the id is not handed on. The cache
+# is bounded by an estimate of the memory held by the tables.
+WARM_KEYS_SIZE = 1024
+WARM_KEYS_BYTES = 16 * 1024 * 1024
+# memory a table takes per bit of the curve order, measured with ecdsa 0.19
+TABLE_BYTES_PER_BIT = 200
+WARM_KEYS = LRUCache(WARM_KEYS_SIZE, WARM_KEYS_BYTES,
+                     lambda key, entry: entry[1].curve.order.bit_length() * TABLE_BYTES_PER_BIT)
+
+def warm_up(key):
+    """
+    Build point multiplication tables for an ``ecdsa`` verifying key, which
+    about halve the time ES256, ES384 and ES512 take to verify with it, and
+    return the warmed copy. ``ECDSA`` verification picks the copy up whenever
+    it is given ``key``, as long as the copy stays in ``WARM_KEYS``.
+
+    Building the tables costs about as much as 40 verifications, so this pays
+    off for long-lived keys. Signing keys are returned as they are: ``ecdsa``
+    already keeps tables for the curve generators that signing multiplies.
+    """
+    import ecdsa
+    if not isinstance(key, ecdsa.VerifyingKey):
+        return key
+    warm = WARM_KEYS.get(id(key))
+    if warm is not None and warm[0] is key:
+        return warm[1]
+    from ecdsa.ellipticcurve import PointJacobi
+    (curve, point) = (key.curve, key.pubkey.point)
+    # a copy with the curve order attached, which the tables need and keys
+    # parsed from strings lack
+    table = PointJacobi(curve.curve, point.x(), point.y(), 1, curve.order, generator=True)
+    copy = ecdsa.VerifyingKey.from_public_point(table, curve=curve, hashfunc=key.default_hashfunc,
+                                                validate_point=False)
+    # the tables are built on first use; use it now
+    table * 2
+    WARM_KEYS.put(id(key), (key, copy))
+    return copy
+
+def key_fingerprint(key):
+    """
+    A hex digest identifying the material of ``key``. Strings are hashed as
+    they are, ``HMACKey`` objects by their secret; other key objects are
+    hashed through their DER export (``ecdsa``, ``Crypto`` and
+    ``cryptography`` keys) or, failing that, their pickle.
+    """
+    if isinstance(key, (binary_type, text_type, HMACKey)):
+        material = secret_bytes(key)
+    elif hasattr(key, 'to_der'):
+        material = key.to_der()
+    elif hasattr(key, 'exportKey'):
+        material = key.exportKey('DER')
+    elif hasattr(key, 'private_bytes') or hasattr(key, 'public_bytes'):
+        material = cryptography_der(key)
+    else:
+        import pickle
+        material = pickle.dumps(key, 2)
+    return hashlib.sha256(material).hexdigest()
+
+def cryptography_der(key):
+    """The DER export of a ``cryptography`` key: PKCS#8 if private, else SubjectPublicKeyInfo."""
+    from cryptography.hazmat.primitives import serialization
+    if hasattr(key, 'private_bytes'):
+        return key.private_bytes(serialization.Encoding.DER, serialization.PrivateFormat.PKCS8,
+                                 serialization.NoEncryption())
+    return key.public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+
 # algorithm routing
+#
+# Routes are compiled once and resolved endpoints are cached by ``alg`` name.
+# The compiled table remembers which ``CUSTOM`` and ``DEFAULT`` it was built
+# from, so reassigning or mutating either one rebuilds it (and starts a fresh
+# cache) on the next lookup. Cached endpoints are shared between calls, so
+# algorithm classes must not keep per-message state on the instance.
+ROUTE_CACHE_SIZE = 256
+_routing = (None, (), LRUCache(0))
+
+def _routing_table():
+    global _routing
+    source = (tuple(CUSTOM), DEFAULT)
+    table = _routing
+    if table[0] != source:
+        routes = tuple((re.compile(pattern), endpoint) for (pattern, endpoint) in source[0] + source[1])
+        table = _routing = (source, routes, LRUCache(ROUTE_CACHE_SIZE))
+    return table
+
+def clear_route_cache():
+    """Forget all resolved endpoints; routes are recompiled on next use."""
+    global _routing
+    _routing = (None, (), LRUCache(0))
+
 def route(name):
-    return resolve(*find(name))
+    (source, routes, cache) = _routing_table()
+    crypt = cache.get(name)
+    if crypt is None:
+        crypt = resolve(*_find(routes, name))
+        cache.put(name, crypt)
+    return crypt
 
 def find(name):
+    return _find(_routing_table()[1], name)
+
+def _find(routes, name):
     # TODO: more error checking around custom algorithms
-    algorithms = CUSTOM + list(DEFAULT)
-    for (route, endpoint) in algorithms:
-        match = re.match(route, name)
+    for (route, endpoint) in routes:
+        match = route.match(name)
         if match:
             return (endpoint, match)
     raise RouteMissingError('endpoint matching %s could not be found' % name)
@@ -176,8 +394,23 @@ def resolve(endpoint, match):
         assert callable(crypt['verify'])
     except AssertionError as e:
         raise RouteEndpointError('sign, verify of endpoint must be callable')
+    # pick up the optional helpers the endpoint provides
+    for name in OPTIONAL_METHODS:
+        try:
+            method = endpoint[name]
+        except (TypeError, KeyError):
+            method = getattr(endpoint, name, None)
+        if callable(method):
+            crypt[name] = method
     return crypt
 
+# methods an endpoint may provide beyond sign and verify.
+#   ``prepare_key(key)``: parse a key once so it can be reused for many messages
+#   ``new_hash(key)``: a hash object to ``update()`` with the message in pieces
+#   ``sign_hash(hash, key)``, ``verify_hash(hash, crypto, key)``: sign or
+#       verify the message fed to a ``new_hash`` object
+OPTIONAL_METHODS = ('prepare_key', 'new_hash', 'sign_hash', 'verify_hash')
+
 DEFAULT = (
     (r'^HS(?P<bits>256|384|512)$', HMAC),
     (r'^RS(?P<bits>256|384|512)$', RSA_PKCS1_5),
@@ -185,3 +418,22 @@ DEFAULT = (
     (r'^ES(?P<bits>256|384|512)$', ECDSA),
 )
 CUSTOM = []
+
+# ``DEFAULT`` for each backend ``set_backend`` knows; 'cryptography' is added
+# when it is first selected
+BACKENDS = {'default': DEFAULT}
+
+def set_backend(name):
+    """
+    Serve RS*, PS* and ES* from another backend: ``'cryptography'`` for the
+    ``cryptography`` package (OpenSSL), or ``'default'`` for ``Crypto`` and
+    ``ecdsa``. This replaces ``DEFAULT``; routes in ``CUSTOM`` still win.
+    """
+    global DEFAULT
+    if name == 'cryptography' and name not in BACKENDS:
+        from . import openssl
+        BACKENDS[name] = openssl.ROUTES
+    try:
+        DEFAULT = BACKENDS[name]
+    except KeyError:
+        raise ValueError("Unknown backend %r (known: %s)" % (name, ', '.join(sorted(BACKENDS))))
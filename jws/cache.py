@@ -0,0 +1,93 @@
+from __future__ import absolute_import
+
+import hashlib
+import sys
+import time
+
+import jws.utils as utils
+from .algos import key_fingerprint
+
+# bookkeeping counted against ``maxbytes`` for every entry on top of its key
+ENTRY_OVERHEAD = 160
+
+class VerificationCache(object):
+    """
+    Remembers tokens that verified, so verifying the same token against the
+    same key again skips the signature check. Pass one as ``cache`` to
+    ``jws.verify`` or ``jws.decode``; the header is still processed and the key
+    resolved on every call, only the cryptography is skipped.
+
+    Entries are keyed by a SHA-256 over the signing input, the signature and
+    the key's fingerprint, and only successful verifications are stored. The
+    cache holds at most ``maxsize`` entries and roughly ``maxbytes`` bytes,
+    dropping the least recently used first. An entry lives for ``ttl``
+    seconds, or until the payload's ``exp`` claim if that is sooner.
+    """
+    def __init__(self, maxsize=4096, maxbytes=1024 * 1024, ttl=300):
+        self.ttl = ttl
+        self.expired = 0
+        self._entries = utils.LRUCache(maxsize, maxbytes, _sizeof)
+        # fingerprints by id(key); the key is kept alongside so the id is not reused
+        self._fingerprints = utils.LRUCache(64)
+
+    def get(self, signing_input, signature, key):
+        """The stored verifier result for this signature and key, or None."""
+        entry_key = self._entry_key(signing_input, signature, key)
+        entry = self._entries.get(entry_key)
+        if entry is None:
+            return None
+        (expires, value) = entry
+        if expires <= time.time():
+            self._entries.pop(entry_key)
+            self.expired += 1
+            return None
+        return value
+
+    def put(self, signing_input, signature, key, value, payload=None):
+        """Remember a successful verification of this signature and key."""
+        expires = time.time() + self.ttl
+        exp = payload.get('exp') if isinstance(payload, dict) else None
+        if isinstance(exp, (int, float)) and not isinstance(exp, bool):
+            expires = min(expires, exp)
+        self._entries.put(self._entry_key(signing_input, signature, key), (expires, value))
+
+    def clear(self):
+        self._entries.clear()
+
+    @property
+    def hits(self):
+        return self._entries.hits
+
+    @property
+    def misses(self):
+        return self._entries.misses
+
+    @property
+    def evictions(self):
+        return self._entries.evictions
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'expired': self.expired, 'entries': len(self._entries), 'bytes': self._entries.size}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _entry_key(self, signing_input, signature, key):
+        digest = hashlib.sha256(utils.to_bytes_2and3(signing_input))
+        digest.update(b'.')
+        digest.update(utils.to_bytes_2and3(signature))
+        digest.update(b'.')
+        digest.update(utils.to_bytes_2and3(self._fingerprint(key)))
+        return digest.digest()
+
+    def _fingerprint(self, key):
+        known = self._fingerprints.get(id(key))
+        if known is not None and known[0] is key:
+            return known[1]
+        fingerprint = key_fingerprint(key)
+        self._fingerprints.put(id(key), (key, fingerprint))
+        return fingerprint
+
+def _sizeof(entry_key, entry):
+    return len(entry_key) + sys.getsizeof(entry[1]) + ENTRY_OVERHEAD
@@ -0,0 +1,188 @@
+"""
+Sign or verify a stream of records from the command line.
+
+    jws sign --key ec.pem --header '{"alg": "ES256"}' claims.jsonl > tokens.jsonl
+    jws verify --key jwks.json --workers 4 < tokens.jsonl > results.jsonl
+
+``sign`` reads one JSON payload per line. ``verify`` reads one compact token
+per line, or a JSON object per line with the token as ``"token"`` -- so the
+output of ``sign`` can be verified as it is. Blank lines are skipped. Both
+write one JSON result per record, in input order, and a summary to stderr.
+The exit status is 1 if any record failed.
+
+The key is a PEM file (RSA or EC), a JWK or JWKS file, or any other file,
+whose bytes are the HMAC secret; or give the secret with ``--secret``. A JWKS
+picks keys by the ``kid`` header.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import errno
+import io
+import os
+import json
+import sys
+import time
+
+import jws
+from jws.keys import KeyStore, from_jwk
+from jws.parallel import imap_bounded, _chunks
+
+# what a worker process sets up once: the key and the header. The main
+# process uses it too when there are no workers.
+_STATE = {}
+
+def main(argv=None, stdin=None, stdout=None, stderr=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('input', nargs='?', default='-', help='file to read, or - for stdin (the default)')
+    common.add_argument('--key', help='PEM, JWK or JWKS file, or a file holding an HMAC secret')
+    common.add_argument('--secret', help='HMAC secret')
+    common.add_argument('--workers', type=int, default=0, help='worker processes (default: none)')
+    common.add_argument('--chunk-size', type=int, default=256, help='records per task (default 256)')
+    common.add_argument('--max-pending', type=int, help='chunks in flight at once (default 2 per worker)')
+    parser = argparse.ArgumentParser(prog='jws', description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    sign = commands.add_parser('sign', parents=[common], help='sign one JSON payload per line')
+    sign.add_argument('--header', required=True, help='JSON header to sign with, e.g. \'{"alg": "HS256"}\'')
+    commands.add_parser('verify', parents=[common], help='verify one token per line')
+    args = parser.parse_args(argv)
+    if (args.key is None) == (args.secret is None):
+        parser.error('give one of --key and --secret')
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+
+    options = {'command': args.command, 'key': args.key, 'secret': args.secret, 'header': getattr(args, 'header', None)}
+    opened = None
+    if args.input == '-':
+        lines = stdin or sys.stdin
+    else:
+        lines = opened = io.open(args.input, encoding='utf8')
+    records = (line.strip() for line in lines)
+    chunks = _chunks((record for record in records if record), args.chunk_size)
+
+    start = time.time()
+    pool = None
+    if args.workers > 0:
+        from multiprocessing import Pool
+        pool = Pool(args.workers, _setup, (options,))
+        results = imap_bounded(pool, _work, chunks, args.max_pending or 2 * args.workers)
+    else:
+        _setup(options)
+        results = (_work(chunk) for chunk in chunks)
+
+    (count, errors) = (0, {})
+    try:
+        for chunk in results:
+            for (output, error) in chunk:
+                count += 1
+                if error:
+                    errors[error] = errors.get(error, 0) + 1
+                print(output, file=stdout)
+    except IOError as e:
+        # the reader went away, as with ``| head``
+        if e.errno != errno.EPIPE:
+            raise
+        if stdout is sys.stdout:
+            # so that flushing stdout at exit does not fail again
+            os.dup2(os.open(os.devnull, os.O_WRONLY), stdout.fileno())
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if opened is not None:
+            opened.close()
+    elapsed = time.time() - start
+    print(summary(args.command, count, errors, elapsed), file=stderr)
+    return 1 if errors else 0
+
+def summary(command, count, errors, elapsed):
+    failed = sum(errors.values())
+    line = 'jws %s: %d records, %d ok, %d failed' % (command, count, count - failed, failed)
+    if errors:
+        line += ' (%s)' % ', '.join('%s: %d' % item for item in sorted(errors.items()))
+    return line + ' in %.2fs, %.1f records/s' % (elapsed, count / elapsed if elapsed else 0.0)
+
+def load_key(path=None, secret=None, private=False):
+    """
+    The key in ``path`` -- the private one if ``private`` and there is one --
+    or a ``KeyStore`` for a JWKS; or ``secret``.
+    """
+    if secret is not None:
+        return secret
+    with open(path, 'rb') as f:
+        material = f.read()
+    text = material.strip()
+    if text.startswith(b'{'):
+        jwk = json.loads(text.decode('utf8'))
+        if 'keys' in jwk:
+            return KeyStore(jwk)
+        return from_jwk(jwk)[1 if private else 0]
+    if text.startswith(b'-----BEGIN'):
+        import ecdsa
+        try:
+            if b'PRIVATE' in text:
+                key = ecdsa.SigningKey.from_pem(text)
+                return key if private else key.get_verifying_key()
+            return ecdsa.VerifyingKey.from_pem(text)
+        except (ecdsa.der.UnexpectedDER, ValueError):
+            import Crypto.PublicKey.RSA as RSA
+            return RSA.importKey(text)
+    return material.rstrip(b'\r\n')
+
+def _setup(options):
+    command = options['command']
+    key = load_key(options['key'], options['secret'], private=(command == 'sign'))
+    if command == 'sign' and isinstance(key, KeyStore):
+        store = key
+        key = lambda header: store.get(header.get('kid'), private=True)
+    _STATE.update(options, loaded=key)
+    if options['header']:
+        _STATE['parsed_header'] = json.loads(options['header'])
+
+def _work(records):
+    # [(output line, error name or None)] for a chunk of input lines
+    if _STATE['command'] == 'sign':
+        return _sign(records)
+    return _verify(records)
+
+def _sign(records):
+    header = _STATE['parsed_header']
+    results = []
+    items = []
+    for record in records:
+        try:
+            items.append((header, json.loads(record)))
+        except ValueError as e:
+            items.append(e)
+    signed = jws.sign_many((item for item in items if not isinstance(item, Exception)), _STATE['loaded'])
+    for item in items:
+        result = item if isinstance(item, Exception) else next(signed)
+        if isinstance(result, Exception):
+            results.append(_failure(result))
+        elif result.ok:
+            results.append((json.dumps({'ok': True, 'token': result.value}), None))
+        else:
+            results.append(_failure(result.error))
+    return results
+
+def _verify(records):
+    tokens = []
+    for record in records:
+        if record.startswith('{'):
+            try:
+                record = json.loads(record)['token']
+            except (ValueError, KeyError, TypeError):
+                pass
+        tokens.append(record)
+    results = []
+    for result in jws.verify_many(tokens, _STATE['loaded']):
+        if result.ok:
+            results.append((json.dumps({'ok': True, 'header': result.header, 'payload': result.payload}), None))
+        else:
+            results.append(_failure(result.error))
+    return results
+
+def _failure(error):
+    name = error.__class__.__name__
+    return (json.dumps({'ok': False, 'error': '%s: %s' % (name, error)}), name)
@@ -0,0 +1,50 @@
+from __future__ import absolute_import
+
+import jws
+import jws.utils as utils
+
+class SigningContext(object):
+    """
+    Signs many payloads with one header and key.
+
+        >>> context = jws.SigningContext({'alg': 'ES256', 'typ': 'JWT'}, sk256)
+        >>> token = context.token({'sub': 'someone'})
+
+    The header is processed, routed and encoded and the key prepared once,
+    when the context is made; after that only the payload is encoded. Where
+    the algorithm hashes incrementally, the hash of the header segment is
+    kept too, and each signature starts from a copy of it. Nothing changes
+    after construction, so one context can be shared between threads.
+    """
+    def __init__(self, head, key=None, codec=None, keystore=None):
+        data = jws._process(head, None, key, 'sign', keystore=keystore)
+        algorithm = data.get('algorithm') or {}
+        prepare = algorithm.get('prepare_key')
+        self.header = dict(head)
+        self.codec = codec
+        self.head_input = utils.encode(head, codec)
+        self._key = prepare(data['key']) if prepare else data['key']
+        self._signer = data['signer']
+        self._prefix = self.head_input + b'.'
+        self._hash = None
+        if 'new_hash' in algorithm and 'sign_hash' in algorithm:
+            self._hash = algorithm['new_hash'](self._key)
+            self._hash.update(self._prefix)
+            self._sign_hash = algorithm['sign_hash']
+
+    def sign(self, payload):
+        """The base64url encoded signature of ``payload``, as ``jws.sign`` returns."""
+        return utils.to_base64(self._sign(utils.encode(payload, self.codec)))
+
+    def token(self, payload):
+        """The compact token for ``payload``, as ``jws.encode`` returns."""
+        payload_input = utils.encode(payload, self.codec)
+        signature = utils.to_base64(self._sign(payload_input))
+        return jws._text(b'.'.join((self._prefix + payload_input, signature)))
+
+    def _sign(self, payload_input):
+        if self._hash is None:
+            return self._signer(self._prefix + payload_input, self._key)
+        hashm = self._hash.copy()
+        hashm.update(payload_input)
+        return self._sign_hash(hashm, self._key)
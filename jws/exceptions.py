@@ -9,3 +9,12 @@ class RouteEndpointError(Exception): pass
 class AlgorithmNotImplemented(Exception): pass
 class ParameterNotImplemented(Exception): pass
 class ParameterNotUnderstood(Exception): pass
+
+# raised by a ``jws.Policy`` before any signature math
+class TokenRejected(Exception): pass
+class TokenTooLarge(TokenRejected): pass
+class MalformedToken(TokenRejected): pass
+class AlgorithmNotAllowed(TokenRejected): pass
+class TokenExpired(TokenRejected): pass
+class TokenNotYetValid(TokenRejected): pass
+class TokenIssuedInFuture(TokenRejected): pass
@@ -1,10 +1,18 @@
 from __future__ import absolute_import
 
 import jws.algos as algos
+import jws.utils as utils
 
 from .exceptions import AlgorithmNotImplemented, ParameterNotImplemented, ParameterNotUnderstood, RouteMissingError
 
 class HeaderBase(object):
+    # True when the handler's outcome depends on nothing but the header, so
+    # ``process`` can remember it for headers it has seen before. Handlers
+    # that read or set the key, or anything else in ``data``, leave it False.
+    # Only a class's own setting counts: subclasses are not cacheable unless
+    # they say so themselves.
+    cacheable = False
+
     def __init__(self, name, value, data):
         self.name = name
         self.value = self.clean(value)
@@ -14,22 +22,41 @@ class HeaderBase(object):
     def clean(self, value): return value
 
 class GenericString(HeaderBase):
+    cacheable = True
     def clean(self, value):
         return str(value)
 
 class SignNotImplemented(HeaderBase):
+    cacheable = True
     def sign(self):
         raise ParameterNotImplemented("Header Parameter %s not implemented in the context of signing" % self.name)
 
 class VerifyNotImplemented(HeaderBase):
+    cacheable = True
     def verify(self):
         raise ParameterNotImplemented("Header Parameter %s not implemented in the context of verifying" % self.name)
 
 class NotImplemented(HeaderBase):
+    cacheable = True
     def clean(self, *a):
         raise ParameterNotUnderstood("Could not find an action for Header Parameter '%s'" % self.name)
 
+class KeyId(HeaderBase):
+    """
+    ``kid``: when a ``keystore`` was passed along and no key was, use the
+    store's key for this id -- the private one when signing.
+    """
+    def sign(self):
+        self.lookup(private=True)
+    def verify(self):
+        self.lookup(private=False)
+    def lookup(self, private):
+        store = self.data.get('keystore')
+        if store is not None and not self.data.get('key'):
+            self.data['key'] = store.get(self.value, private)
+
 class Algorithm(HeaderBase):
+    cacheable = True
     def clean(self, value):
         try:
             self.methods = algos.route(value)
@@ -38,8 +65,45 @@ class Algorithm(HeaderBase):
 
     def sign(self):
         self.data['signer'] = self.methods['sign']
+        self.data['algorithm'] = self.methods
     def verify(self):
         self.data['verifier'] = self.methods['verify']
+        self.data['algorithm'] = self.methods
+
+class Base64Payload(HeaderBase):
+    """
+    RFC 7797 ``b64``: when false, the payload is signed as it is rather than
+    base64url encoded. It must be listed in ``crit``.
+    """
+    cacheable = True
+    def clean(self, value):
+        if value not in (True, False):
+            raise ParameterNotUnderstood("Header Parameter b64 must be true or false")
+        return value
+    def sign(self):
+        if self.name not in self.data['header'].get('crit', ()):
+            raise ParameterNotUnderstood("Header Parameter b64 must be listed in crit")
+        self.data['b64'] = self.value
+    verify = sign
+
+class Critical(HeaderBase):
+    """
+    ``crit``: parameters that must be understood. Each one has to be a known
+    header parameter that is present in the header.
+    """
+    cacheable = True
+    def clean(self, value):
+        if not isinstance(value, list) or not value:
+            raise ParameterNotUnderstood("Header Parameter crit must be a non-empty list")
+        for name in value:
+            if name not in KNOWN_HEADERS:
+                raise ParameterNotUnderstood("Critical Header Parameter '%s' not understood" % name)
+        return value
+    def sign(self):
+        for name in self.value:
+            if name not in self.data['header']:
+                raise ParameterNotUnderstood("Critical Header Parameter '%s' missing" % name)
+    verify = sign
 
 KNOWN_HEADERS = {
     # REQUIRED, signing algo, see signing_methods
@@ -49,22 +113,91 @@ KNOWN_HEADERS = {
     # OPTIONAL, JSON Key URL. See http://self-issued.info/docs/draft-jones-json-web-key.html
     'jku': VerifyNotImplemented,
      # OPTIONAL, key id, hint for which key to use.
-    'kid': VerifyNotImplemented,
+    'kid': KeyId,
     # OPTIONAL, x.509 URL pointing to certificate or certificate chain
     'x5u': VerifyNotImplemented,
     # OPTIONAL, x.509 certificate thumbprint
     'x5t': VerifyNotImplemented,
+    # OPTIONAL, whether the payload is base64url encoded. See RFC 7797
+    'b64': Base64Payload,
+    # OPTIONAL, parameters that must be understood. See RFC 7515 4.1.11
+    'crit': Critical,
 }
 
+# how many distinct headers ``process`` remembers the outcome of; the memo
+# starts over when it fills up
+HEADER_CACHE_SIZE = 256
+
+def compile_headers(known):
+    """
+    Turn a mapping of header parameter to handler class, like
+    ``KNOWN_HEADERS``, into a function ``validate(data, step, memo=None,
+    segment=None)``. Given a dict as ``memo``, the outcome of the cacheable
+    handlers is remembered per header -- or per encoded header ``segment``,
+    when there is one -- and replayed for the next identical one. The other
+    handlers run on every call.
+    """
+    known = dict(known)
+    live = dict((name, cls) for (name, cls) in known.items() if not cls.__dict__.get('cacheable', False))
+
+    def validate(data, step, memo=None, segment=None):
+        header = data['header']
+        key = updates = None
+        if memo is not None:
+            key = (step, segment) if segment is not None else (step, tuple(header.items()))
+            try:
+                updates = memo.get(key)
+            except TypeError:
+                # unhashable values, such as a crit list
+                key = None
+        if updates is None:
+            # The JWS Header Input MUST be validated to only include parameters
+            # and values whose syntax and semantics are both understood and
+            # supported. --- this is why it defaults to NotImplemented, which
+            # raises an exception
+            scratch = {'header': header}
+            for param in header:
+                if param not in live:
+                    _run(known.get(param, NotImplemented), param, scratch, step)
+            del scratch['header']
+            updates = scratch
+            if key is not None and (segment is not None or _all_text(header)):
+                if len(memo) >= HEADER_CACHE_SIZE:
+                    memo.clear()
+                memo[key] = updates
+        data.update(updates)
+        if live:
+            for param in header:
+                if param in live:
+                    _run(live[param], param, data, step)
+        return data
+    return validate
+
+# (KNOWN_HEADERS copy, routing table, validator, memo)
+_compiled = (None, None, None, None)
+
+def _validator():
+    global _compiled
+    # remembered outcomes hold routed algorithms, so they go with the routes
+    routing = algos._routing_table()
+    compiled = _compiled
+    if compiled[1] is not routing or compiled[0] != KNOWN_HEADERS:
+        compiled = _compiled = (dict(KNOWN_HEADERS), routing, compile_headers(KNOWN_HEADERS), {})
+    return compiled
+
+def _run(cls, param, data, step):
+    instance = cls(param, data['header'][param], data)
+    getattr(instance, step)()
+
+def _all_text(header):
+    # only headers of strings are remembered by value: 1 == True, but a
+    # string never equals anything but a string
+    for value in header.values():
+        if not isinstance(value, (utils.text_type, utils.binary_type)):
+            return False
+    return True
+
 # data is by reference
-def process(data, step):
-    for param in data['header']:
-        # The JWS Header Input MUST be validated to only include parameters
-        # and values whose syntax and semantics are both understood and
-        # supported. --- this is why it defaults to NotImplemented, which
-        # raises an exception
-        cls = KNOWN_HEADERS.get(param, NotImplemented)
-        instance = cls(param, data['header'][param], data)
-        procedure = getattr(instance, step)
-        procedure()
-    return data
+def process(data, step, segment=None):
+    (_, _, validate, memo) = _validator()
+    return validate(data, step, memo, segment)
@@ -0,0 +1,131 @@
+from __future__ import absolute_import
+
+import functools
+import threading
+
+import jws
+import jws.utils as utils
+from .exceptions import MissingKey, SignatureError
+from .multi import _outcomes
+
+# how much the scores of the other keys of an issuer fade on every match
+DECAY = 0.9
+# how many issuers the ring keeps scores for
+ISSUERS = 1024
+
+class KeyRing(object):
+    """
+    Several keys that may each have signed a token, as during key rotation.
+
+        >>> ring = jws.KeyRing({'2024': old_vk, '2025': new_vk})
+        >>> header, claims, name = ring.decode(token)
+
+    ``keys`` is a dict of name to key, or a list of keys named by position.
+    The header is processed and the signing input built once per token; then
+    the keys are tried until one verifies the signature, and its name is
+    returned. Keys are tried in order of recent success for the token's
+    ``iss`` claim, so after a rotation the new key soon comes first for each
+    issuer. ``matched`` counts the matches per name, which shows when an old
+    key can be retired.
+
+    Given a ``concurrent.futures`` executor, the keys are tried on it at once
+    and those still queued when one matches are cancelled; that pays off with
+    verifiers that release the GIL, such as the ``cryptography`` backend.
+    """
+    def __init__(self, keys=(), executor=None):
+        self.executor = executor
+        self.matched = {}
+        self._lock = threading.Lock()
+        # issuer -> {name: score}
+        self._scores = utils.LRUCache(ISSUERS)
+        # (name, key) pairs -- replaced, never mutated in place
+        self._keys = ()
+        for (name, key) in (keys.items() if isinstance(keys, dict) else enumerate(keys)):
+            self.add(name, key)
+
+    def add(self, name, key):
+        """Add ``key``, or replace the key called ``name``."""
+        with self._lock:
+            self._keys = tuple(item for item in self._keys if item[0] != name) + ((name, key),)
+
+    def remove(self, name):
+        """Stop trying the key called ``name``."""
+        with self._lock:
+            self._keys = tuple(item for item in self._keys if item[0] != name)
+
+    def candidates(self, issuer=None):
+        """The ``(name, key)`` pairs in the order they are tried for ``issuer``."""
+        keys = self._keys
+        scores = self._scores.get(issuer)
+        if not scores:
+            return list(keys)
+        with self._lock:
+            scores = dict(scores)
+        # sorted is stable, so keys that never matched keep the ring's order
+        return sorted(keys, key=lambda item: -scores.get(item[0], 0.0))
+
+    def verify(self, head, payload, encoded_signature, is_json=False, codec=None):
+        """The name of the key that verifies the signature, as for ``jws.verify``."""
+        data = self._process(head, payload, is_json, codec)
+        return self._check(data, jws._signing_input(head, payload, is_json, codec), encoded_signature)
+
+    def decode(self, token, codec=None, policy=None):
+        """``(header, payload, name)`` for a compact token, as for ``jws.decode``."""
+        if policy is not None:
+            policy.check_size(token)
+        (signing_input, head_input, payload_input, encoded_signature) = jws._split(token)
+        if policy is not None:
+            policy.check_segments(signing_input, head_input, payload_input, encoded_signature)
+        head = utils.decode(head_input, codec)
+        if policy is not None:
+            policy.check_header(head)
+        payload = utils.decode(payload_input, codec)
+        if policy is not None:
+            policy.check_claims(payload)
+        data = self._process(head, payload, segment=head_input.tobytes())
+        return (head, payload, self._check(data, signing_input, encoded_signature))
+
+    def _process(self, head, payload, is_json=False, codec=None, segment=None):
+        keys = self._keys
+        if not keys:
+            raise MissingKey("The key ring is empty")
+        # the header does not depend on the key; any one will do
+        return jws._process(head, payload, keys[0][1], 'verify', is_json, codec=codec, segment=segment)
+
+    def _check(self, data, signing_input, encoded_signature):
+        signature = utils.from_base64(encoded_signature)
+        payload = data['payload']
+        issuer = payload.get('iss') if isinstance(payload, dict) else None
+        if not isinstance(issuer, (utils.text_type, utils.binary_type)):
+            issuer = None
+        candidates = self.candidates(issuer)
+        prepare = (data.get('algorithm') or {}).get('prepare_key')
+        checks = [functools.partial(_verify, data['verifier'], prepare, signing_input, signature, key)
+                  for (_, key) in candidates]
+        error = None
+        outcomes = _outcomes(checks, self.executor)
+        try:
+            for (index, _, e) in outcomes:
+                if e is None:
+                    name = candidates[index][0]
+                    self._record(issuer, name)
+                    return name
+                error = e
+        finally:
+            outcomes.close()
+        raise SignatureError("None of the %d keys verified the signature; the last one failed with %s: %s"
+                             % (len(checks), error.__class__.__name__, error))
+
+    def _record(self, issuer, name):
+        with self._lock:
+            self.matched[name] = self.matched.get(name, 0) + 1
+            scores = self._scores.get(issuer)
+            if scores is None:
+                scores = {}
+                self._scores.put(issuer, scores)
+            for other in scores:
+                scores[other] *= DECAY
+            scores[name] = scores.get(name, 0.0) + 1
+
+def _verify(verifier, prepare, signing_input, signature, key):
+    return verifier(signing_input, signature, prepare(key) if prepare else key)
@@ -0,0 +1,200 @@
+from __future__ import absolute_import
+
+import binascii
+import hashlib
+import json
+import os
+import threading
+import time
+
+import jws.utils as utils
+
+JWK_CURVES = {'P-256': 'NIST256p', 'P-384': 'NIST384p', 'P-521': 'NIST521p'}
+
+# members that make up the RFC 7638 thumbprint of each key type
+THUMBPRINT_MEMBERS = {'EC': ('crv', 'kty', 'x', 'y'), 'RSA': ('e', 'kty', 'n'), 'oct': ('k', 'kty')}
+
+class KeyStore(object):
+    """
+    Keys indexed by ``kid`` and by RFC 7638 thumbprint, parsed once when they
+    are loaded. Pass one as ``keystore`` to ``jws.verify``, ``jws.decode`` and
+    friends and the ``kid`` header picks the key; or pass it as the key to
+    ``jws.verify_many``, where it works as a resolver.
+
+    A store loaded with ``from_file`` and a ``reload_interval`` checks the
+    file's modification time at most that often on lookup and reloads it when
+    it changed. The check and the reload, with any warming up of keys, run on
+    a background thread; readers keep using the old index until the new one
+    is swapped in, so they never wait on a reload. A reload that fails, say on a file
+    caught half written, leaves the old index in place and is tried again
+    at the next interval; the error is kept in ``reload_error``.
+
+    With ``warm=True`` every EC public key loaded is handed to
+    ``jws.algos.warm_up``, which makes verifying with it about twice as fast
+    for as long as it stays in ``jws.algos.WARM_KEYS``.
+    """
+    def __init__(self, jwks=None, warm=False):
+        self.path = None
+        self.reload_interval = None
+        self.warm = warm
+        self.reload_error = None
+        self._reloader = None
+        self._mtime = None
+        self._checked = 0
+        self._reloading = threading.Lock()
+        self._writing = threading.Lock()
+        # (by kid, by thumbprint) -- replaced, never mutated in place
+        self._index = ({}, {})
+        if jwks is not None:
+            self.load(jwks)
+
+    @classmethod
+    def from_file(cls, path, reload_interval=None, warm=False):
+        """A store holding the JWKS document in ``path``."""
+        store = cls(warm=warm)
+        store.path = path
+        store.reload_interval = reload_interval
+        store.reload()
+        return store
+
+    def load(self, jwks):
+        """Replace the contents of the store with a JWKS document (a dict)."""
+        (by_kid, by_thumbprint) = ({}, {})
+        for jwk in jwks.get('keys', ()):
+            entry = from_jwk(jwk)
+            by_thumbprint[thumbprint(jwk)] = entry
+            if 'kid' in jwk:
+                by_kid[jwk['kid']] = entry
+        if self.warm:
+            # before the swap, so lookups only ever see warm keys
+            self._warm(by_thumbprint.values())
+        with self._writing:
+            self._index = (by_kid, by_thumbprint)
+
+    def warm_up(self):
+        """Build the verification tables of every EC public key in the store."""
+        self._warm(self._index[1].values())
+
+    def _warm(self, entries):
+        from jws.algos import warm_up
+        for (public, _) in entries:
+            if hasattr(public, 'pubkey'):
+                warm_up(public)
+
+    def add(self, key, kid=None, private_key=None):
+        """
+        Add one key: a JWK dict, or a key object stored under ``kid``.
+        ``private_key`` is what signing with that ``kid`` uses, if different.
+        """
+        if isinstance(key, dict):
+            entry = from_jwk(key)
+            kid = key.get('kid', kid)
+        else:
+            entry = (key, private_key or key)
+        with self._writing:
+            (by_kid, by_thumbprint) = (dict(self._index[0]), dict(self._index[1]))
+            if isinstance(key, dict):
+                by_thumbprint[thumbprint(key)] = entry
+            if kid is not None:
+                by_kid[kid] = entry
+            self._index = (by_kid, by_thumbprint)
+
+    def get(self, kid, private=False):
+        """
+        The key for ``kid`` -- the private one if ``private`` -- or None.
+        A ``kid`` that is not known is also tried as a thumbprint.
+        """
+        if self.reload_interval is not None:
+            self._maybe_reload()
+        (by_kid, by_thumbprint) = self._index
+        entry = by_kid.get(kid) or by_thumbprint.get(kid)
+        if entry is None:
+            return None
+        return entry[1] if private else entry[0]
+
+    def find(self, thumbprint, private=False):
+        """The key with the given RFC 7638 thumbprint, or None."""
+        entry = self._index[1].get(thumbprint)
+        if entry is None:
+            return None
+        return entry[1] if private else entry[0]
+
+    def __call__(self, header):
+        # resolver interface for verify_many
+        return self.get(header.get('kid'))
+
+    def reload(self):
+        """Load ``path`` again."""
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path) as f:
+            self.load(json.load(f))
+        self._mtime = mtime
+
+    def _maybe_reload(self):
+        now = time.time()
+        if now - self._checked < self.reload_interval:
+            return
+        # only one reader starts a check, and none waits for it: the check
+        # runs on a thread of its own while lookups use the current index
+        if not self._reloading.acquire(False):
+            return
+        self._checked = now
+        try:
+            self._reloader = threading.Thread(target=self._check)
+            self._reloader.daemon = True
+            self._reloader.start()
+        except Exception:
+            self._reloading.release()
+            raise
+
+    def _check(self):
+        try:
+            if os.stat(self.path).st_mtime != self._mtime:
+                self.reload()
+            self.reload_error = None
+        except Exception as e:
+            # a file being rewritten or replaced: keep the current keys and
+            # try again at the next interval
+            self.reload_error = e
+        finally:
+            self._reloading.release()
+
+def from_jwk(jwk):
+    """
+    Parse a JWK dict into ``(public key, private key)`` objects. Public keys
+    are ``ecdsa`` and ``Crypto`` key objects; for a public JWK both are the
+    same. ``oct`` keys are secrets, as an ``HMACKey`` if the JWK has an ``alg``.
+    """
+    kty = jwk.get('kty')
+    if kty == 'oct':
+        secret = utils.from_base64(jwk['k'])
+        alg = jwk.get('alg', '')
+        if alg.startswith('HS'):
+            from jws.algos import HMACKey
+            secret = HMACKey(secret, alg[2:])
+        return (secret, secret)
+    if kty == 'EC':
+        import ecdsa
+        curve = getattr(ecdsa, JWK_CURVES[jwk['crv']])
+        public = ecdsa.VerifyingKey.from_string(
+            utils.from_base64(jwk['x']) + utils.from_base64(jwk['y']), curve=curve)
+        if 'd' in jwk:
+            return (public, ecdsa.SigningKey.from_string(utils.from_base64(jwk['d']), curve=curve))
+        return (public, public)
+    if kty == 'RSA':
+        import Crypto.PublicKey.RSA as RSA
+        (n, e) = (_int(jwk['n']), _int(jwk['e']))
+        public = RSA.construct((n, e))
+        if 'd' in jwk:
+            return (public, RSA.construct((n, e, _int(jwk['d']), _int(jwk['p']), _int(jwk['q']))))
+        return (public, public)
+    raise ValueError("Unsupported JWK key type %r" % (kty,))
+
+def thumbprint(jwk):
+    """The RFC 7638 thumbprint of a JWK: SHA-256 over its required members."""
+    members = THUMBPRINT_MEMBERS[jwk['kty']]
+    canonical = json.dumps(dict((name, jwk[name]) for name in members), sort_keys=True, separators=(',', ':'))
+    return utils.to_base64(hashlib.sha256(utils.to_bytes_2and3(canonical)).digest()).decode('ascii')
+
+def _int(value):
+    return int(binascii.hexlify(utils.from_base64(value)), 16)
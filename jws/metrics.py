@@ -0,0 +1,167 @@
+"""
+Instrumentation for ``jws.sign``, ``verify``, ``encode`` and ``decode``.
+
+Register a hook with ``add_hook`` (or for a block, ``with recording(hook):``)
+and every call reports an ``Event``: the operation, the ``alg``, the outcome
+-- ``'ok'`` or the name of the exception raised, such as ``'SignatureError'``
+-- the total duration and the time spent in each stage:
+
+* ``split``: cutting a compact token into its segments
+* ``policy``: the checks of a ``jws.Policy``, if one was given
+* ``encode``: serializing and base64url encoding the header and payload
+* ``decode``: base64url decoding and parsing them
+* ``header``: processing the header, which routes the algorithm
+* ``crypto``: preparing the key and signing or verifying (and the
+  ``VerificationCache``, if any)
+
+The stages are timed inside the public functions themselves, so they describe
+the work those do. With no hooks registered the timers do nothing. ``Histograms`` is a hook that aggregates events into
+latency histograms for export.
+"""
+from __future__ import absolute_import
+
+import bisect
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+# registered hooks; replaced, never mutated in place
+HOOKS = ()
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+class Event(namedtuple('Event', 'op alg outcome duration stages')):
+    """
+    One instrumented call. ``duration`` is in seconds and ``stages`` maps the
+    name of each stage the call reached to its seconds.
+    """
+    __slots__ = ()
+
+def add_hook(hook):
+    """Call ``hook(event)`` after every instrumented call. Hooks must not raise."""
+    global HOOKS
+    HOOKS = HOOKS + (hook,)
+
+def remove_hook(hook):
+    global HOOKS
+    HOOKS = tuple(h for h in HOOKS if h is not hook)
+
+@contextmanager
+def recording(hook):
+    """Register ``hook`` for the duration of a ``with`` block."""
+    add_hook(hook)
+    try:
+        yield hook
+    finally:
+        remove_hook(hook)
+
+class Probe(object):
+    """Times one call and its stages, and reports it to the hooks on exit."""
+    def __init__(self, op):
+        self.op = op
+        self.alg = None
+        self.stages = {}
+
+    def __enter__(self):
+        self.start = _clock()
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        outcome = 'ok' if kind is None else kind.__name__
+        event = Event(self.op, self.alg, outcome, _clock() - self.start, self.stages)
+        for hook in HOOKS:
+            hook(event)
+
+    def describe(self, head):
+        """Take the ``alg`` from a decoded header."""
+        if isinstance(head, dict):
+            self.alg = head.get('alg')
+
+    @contextmanager
+    def stage(self, name):
+        start = _clock()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + _clock() - start
+
+class _Off(object):
+    # a probe and its stages while no hooks are registered: they do nothing
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        return False
+
+    def stage(self, name):
+        return self
+
+    def describe(self, head):
+        pass
+
+_OFF = _Off()
+
+def probe(op):
+    """A ``Probe`` for one call of ``op``, or one that does nothing while there are no hooks."""
+    return Probe(op) if HOOKS else _OFF
+
+# upper bounds in seconds, from 10us to 1s
+BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 1.0)
+
+class Histograms(object):
+    """
+    A hook that aggregates events in-process: a histogram of call durations
+    per ``(op, alg, outcome)`` and of stage durations per ``(op, alg, stage)``.
+    ``snapshot()`` returns them as plain data, ready to export.
+
+        >>> histograms = jws.metrics.Histograms()
+        >>> jws.metrics.add_hook(histograms)
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __call__(self, event):
+        with self._lock:
+            self._observe(self._calls, (event.op, event.alg, event.outcome), event.duration)
+            for (stage, seconds) in event.stages.items():
+                self._observe(self._stages, (event.op, event.alg, stage), seconds)
+
+    def reset(self):
+        with self._lock:
+            self._calls = {}
+            self._stages = {}
+
+    def snapshot(self):
+        """
+        ``{'calls': [...], 'stages': [...]}``, each a list of dicts with the
+        labels, ``count``, ``sum`` (seconds) and cumulative ``buckets`` as
+        ``[upper bound, count]`` pairs, the last bound being ``'+Inf'``.
+        """
+        with self._lock:
+            return {
+                'calls': [self._export(('op', 'alg', 'outcome'), key, value) for (key, value) in self._calls.items()],
+                'stages': [self._export(('op', 'alg', 'stage'), key, value) for (key, value) in self._stages.items()],
+            }
+
+    def _observe(self, table, key, seconds):
+        entry = table.get(key)
+        if entry is None:
+            entry = table[key] = [0, 0.0, [0] * (len(self.buckets) + 1)]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def _export(self, labels, key, entry):
+        (count, total, counts) = entry
+        (cumulative, running) = ([], 0)
+        for (bound, n) in zip(self.buckets + ('+Inf',), counts):
+            running += n
+            cumulative.append([bound, running])
+        exported = dict(zip(labels, key))
+        exported.update({'count': count, 'sum': total, 'buckets': cumulative})
+        return exported
@@ -0,0 +1,151 @@
+"""
+The General JWS JSON Serialization (RFC 7515, section 7.2.1): one payload
+signed any number of times, with different headers and keys.
+
+    {"payload": "<payload>",
+     "signatures": [{"protected": "<header>", "header": {...}, "signature": "<signature>"}, ...]}
+"""
+from __future__ import absolute_import
+
+import functools
+
+import jws
+import jws.utils as utils
+from .exceptions import ParameterNotUnderstood, SignatureError
+
+POLICIES = ('all', 'any')
+
+def sign_multi(payload, signers, codec=None, executor=None, keystore=None):
+    """
+    Sign ``payload`` once per item of ``signers`` and return the General JWS
+    JSON Serialization as a dict. An item is ``(header, key)``, or
+    ``(header, key, unprotected header)``.
+
+    The payload is serialized and base64url encoded once, and every signature
+    is computed over those same bytes. Given an executor such as a
+    ``concurrent.futures.ThreadPoolExecutor``, the signatures are computed on
+    it.
+    """
+    payload_input = utils.encode(payload, codec)
+    tasks = []
+    for signer in signers:
+        (head, key, unprotected) = (tuple(signer) + (None,))[:3]
+        data = jws._process(_merge(head, unprotected), payload, key, 'sign', keystore=keystore)
+        tasks.append((utils.encode(head, codec), payload_input, data))
+    if executor is None:
+        signatures = [_sign(task) for task in tasks]
+    else:
+        signatures = list(executor.map(_sign, tasks))
+    entries = []
+    for ((head_input, _, _), signer, signature) in zip(tasks, signers, signatures):
+        entry = {'protected': jws._text(head_input), 'signature': jws._text(utils.to_base64(signature))}
+        if len(signer) > 2 and signer[2]:
+            entry['header'] = signer[2]
+        entries.append(entry)
+    return {'payload': jws._text(payload_input), 'signatures': entries}
+
+def verify_multi(serialized, key_or_resolver=None, policy='all', codec=None, executor=None):
+    """
+    Verify a General (or Flattened) JWS JSON Serialization, given as a dict or
+    as JSON text, and return ``(payload, headers)``: the decoded payload and
+    the header of each signature that verified.
+
+    ``key_or_resolver`` is the key for every signature or a callable, such as
+    a ``KeyStore``, that takes a signature's header and returns its key.
+    With ``policy='all'`` every signature must verify, and the first failure
+    is raised; with ``policy='any'`` one is enough, and checking stops there
+    (or a ``SignatureError`` is raised when none does).
+    Given a ``concurrent.futures`` executor, the signatures are checked on it
+    and those still queued when the outcome is known are cancelled.
+    """
+    if policy not in POLICIES:
+        raise ValueError("policy must be one of %s (given %r)" % (', '.join(POLICIES), policy))
+    if not isinstance(serialized, dict):
+        serialized = utils.from_json(serialized, codec)
+    entries = serialized['signatures'] if 'signatures' in serialized else [serialized]
+    if not entries:
+        raise SignatureError("There are no signatures to verify")
+    payload_input = utils.to_bytes_2and3(serialized['payload'])
+    payload = utils.decode(payload_input, codec)
+    checks = [functools.partial(_verify, entry, payload_input, payload, key_or_resolver, codec) for entry in entries]
+
+    verified = {}
+    error = None
+    outcomes = _outcomes(checks, executor)
+    try:
+        for (index, head, e) in outcomes:
+            if e is not None:
+                if policy == 'all':
+                    raise e
+                error = e
+                continue
+            verified[index] = head
+            if policy == 'any':
+                break
+    finally:
+        outcomes.close()
+    if not verified:
+        raise SignatureError("None of the %d signatures could be verified; the last one failed with %s: %s"
+                             % (len(checks), error.__class__.__name__, error))
+    return (payload, [verified[index] for index in sorted(verified)])
+
+def _sign(task):
+    (head_input, payload_input, data) = task
+    methods = data.get('algorithm') or {}
+    if 'sign_hash' in methods:
+        # feeds the shared payload bytes without joining them to the header
+        return methods['sign_hash'](_hash(methods, data['key'], head_input, payload_input), data['key'])
+    return data['signer'](b'.'.join((head_input, payload_input)), data['key'])
+
+def _verify(entry, payload_input, payload, key_or_resolver, codec):
+    # the signature's header if it verifies
+    head_input = utils.to_bytes_2and3(entry.get('protected', ''))
+    head = _merge(utils.decode(head_input, codec) if head_input else {}, entry.get('header'))
+    key = key_or_resolver(head) if callable(key_or_resolver) else key_or_resolver
+    data = jws._process(head, payload, key, 'verify')
+    signature = utils.from_base64(entry['signature'])
+    methods = data.get('algorithm') or {}
+    if 'verify_hash' in methods:
+        methods['verify_hash'](_hash(methods, data['key'], head_input, payload_input), signature, data['key'])
+    else:
+        data['verifier'](b'.'.join((head_input, payload_input)), signature, data['key'])
+    return head
+
+def _hash(methods, key, head_input, payload_input):
+    hashm = methods['new_hash'](key)
+    hashm.update(head_input)
+    hashm.update(b'.')
+    hashm.update(payload_input)
+    return hashm
+
+def _outcomes(checks, executor):
+    # (index, header, exception) for each check as it finishes
+    if executor is None:
+        for (index, check) in enumerate(checks):
+            yield (index,) + _attempt(check)
+        return
+    from concurrent.futures import as_completed
+    futures = dict((executor.submit(_attempt, check), index) for (index, check) in enumerate(checks))
+    try:
+        for future in as_completed(futures):
+            yield (futures[future],) + future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+def _attempt(check):
+    try:
+        return (check(), None)
+    except Exception as e:
+        return (None, e)
+
+def _merge(protected, unprotected):
+    # the JOSE header: both headers together, which must not share a name
+    if not unprotected:
+        return protected
+    for name in unprotected:
+        if name in protected:
+            raise ParameterNotUnderstood("Header Parameter '%s' is in both the protected and unprotected header" % name)
+    merged = dict(unprotected)
+    merged.update(protected)
+    return merged
@@ -0,0 +1,157 @@
+"""
+RS*, PS* and ES* on the ``cryptography`` package, which calls into OpenSSL.
+Route the defaults to it with ``jws.algos.set_backend('cryptography')``, or
+single algorithms by adding its routes to ``jws.algos.CUSTOM``.
+
+Keys are ``cryptography`` key objects, or anything the default backend takes:
+``Crypto`` and ``ecdsa`` key objects, PEM or DER RSA keys and raw ECDSA
+verifying keys. Those are converted on first use and the conversion is cached.
+"""
+from __future__ import absolute_import
+
+import binascii
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+from cryptography.hazmat.primitives.asymmetric.utils import Prehashed, decode_dss_signature, encode_dss_signature
+
+from .algos import HMAC, HasherBase, KEY_CACHE_SIZE, cached_key
+from .exceptions import SignatureError
+from .utils import LRUCache, binary_type, text_type, to_bytes_2and3
+
+# converted keys by id of the ``Crypto`` or ``ecdsa`` object they came from.
+# The object is kept next to its conversion, so its id is not handed on.
+CONVERTED = LRUCache(KEY_CACHE_SIZE)
+
+class OpenSSLBase(HasherBase):
+    """
+    Base for the algorithms of this backend. Subclasses set ``key_types``,
+    the ``cryptography`` key classes they take, and ``kind``, what string keys
+    are cached under.
+    """
+    def __init__(self, bits):
+        super(OpenSSLBase, self).__init__(bits)
+        self.hash = getattr(hashes, 'SHA%d' % self.bits)()
+        self.prehashed = Prehashed(self.hash)
+
+    def prepare_key(self, key):
+        """Convert ``key`` to a ``cryptography`` key, once per key."""
+        if isinstance(key, self.key_types):
+            return key
+        if isinstance(key, (binary_type, text_type)):
+            return cached_key(to_bytes_2and3(key), self.kind, self.parse)
+        known = CONVERTED.get(id(key))
+        if known is None or known[0] is not key:
+            known = (key, self.convert(key))
+            CONVERTED.put(id(key), known)
+        return known[1]
+
+    def convert(self, key):
+        # ``ecdsa`` keys export DER with ``to_der``, ``Crypto`` keys with ``exportKey``
+        if hasattr(key, 'to_der'):
+            return _load_der(key.to_der())
+        if hasattr(key, 'exportKey'):
+            return _load_der(key.exportKey('DER'))
+        raise TypeError("%s cannot use a key of type %s" % (self.__class__.__name__, type(key).__name__))
+
+    def public_key(self, key):
+        key = self.prepare_key(key)
+        return key.public_key() if hasattr(key, 'public_key') else key
+
+    def sign(self, msg, key):
+        return self.sign_input(to_bytes_2and3(msg), self.prepare_key(key), self.hash)
+
+    def verify(self, msg, crypto, key):
+        return self.verify_input(to_bytes_2and3(msg), crypto, self.public_key(key), self.hash)
+
+    def new_hash(self, key):
+        return self.hasher()
+
+    def sign_hash(self, hashm, key):
+        return self.sign_input(hashm.digest(), self.prepare_key(key), self.prehashed)
+
+    def verify_hash(self, hashm, crypto, key):
+        return self.verify_input(hashm.digest(), crypto, self.public_key(key), self.prehashed)
+
+class RSABase(OpenSSLBase):
+    key_types = (rsa.RSAPrivateKey, rsa.RSAPublicKey)
+    kind = ('cryptography', 'RSA')
+
+    def parse(self, material):
+        if material.startswith(b'-----'):
+            try:
+                return serialization.load_pem_private_key(material, None)
+            except ValueError:
+                return serialization.load_pem_public_key(material)
+        return _load_der(material)
+
+    def sign_input(self, data, key, algorithm):
+        return key.sign(data, self.padding(), algorithm)
+
+    def verify_input(self, data, crypto, key, algorithm):
+        try:
+            key.verify(crypto, data, self.padding(), algorithm)
+        except InvalidSignature:
+            raise SignatureError("Could not validate signature")
+        return True
+
+class RSA_PKCS1_5(RSABase):
+    def padding(self):
+        return padding.PKCS1v15()
+
+class RSA_PSS(RSABase):
+    def padding(self):
+        # JWA: MGF1 with the same hash, and a salt as long as the digest
+        return padding.PSS(mgf=padding.MGF1(self.hash), salt_length=self.hash.digest_size)
+
+class ECDSA(OpenSSLBase):
+    """
+    ECDSA over P-256, P-384 and P-521. Signatures are the JWS ``r || s``
+    concatenation, not the DER that OpenSSL produces.
+    """
+    key_types = (ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey)
+    bits_to_curve = {256: ec.SECP256R1, 384: ec.SECP384R1, 512: ec.SECP521R1}
+
+    def __init__(self, bits):
+        super(ECDSA, self).__init__(bits)
+        self.curve = self.bits_to_curve[self.bits]()
+        self.kind = ('cryptography', self.curve.name)
+        self.size = (self.curve.key_size + 7) // 8
+
+    def parse(self, material):
+        # the raw ``x || y`` verifying key the default backend takes
+        return ec.EllipticCurvePublicKey.from_encoded_point(self.curve, b'\x04' + material)
+
+    def sign_input(self, data, key, algorithm):
+        (r, s) = decode_dss_signature(key.sign(data, ec.ECDSA(algorithm)))
+        return _bytes(r, self.size) + _bytes(s, self.size)
+
+    def verify_input(self, data, crypto, key, algorithm):
+        if len(crypto) != 2 * self.size:
+            raise SignatureError("Could not validate signature")
+        signature = encode_dss_signature(_int(crypto[:self.size]), _int(crypto[self.size:]))
+        try:
+            key.verify(signature, data, ec.ECDSA(algorithm))
+        except InvalidSignature:
+            raise SignatureError("Could not validate signature")
+        return True
+
+ROUTES = (
+    (r'^HS(?P<bits>256|384|512)$', HMAC),
+    (r'^RS(?P<bits>256|384|512)$', RSA_PKCS1_5),
+    (r'^PS(?P<bits>256|384|512)$', RSA_PSS),
+    (r'^ES(?P<bits>256|384|512)$', ECDSA),
+)
+
+def _load_der(der):
+    try:
+        return serialization.load_der_private_key(der, None)
+    except ValueError:
+        return serialization.load_der_public_key(der)
+
+def _int(data):
+    return int(binascii.hexlify(data), 16)
+
+def _bytes(number, size):
+    return binascii.unhexlify('%0*x' % (2 * size, number))
@@ -0,0 +1,172 @@
+from __future__ import absolute_import
+
+from collections import deque
+from itertools import islice
+
+import jws
+from .algos import cached_key, cryptography_der, key_fingerprint
+from .keys import KeyStore
+
+# keys pinned in this process by fingerprint. Workers get these once from the
+# pool initializer; tasks only name them.
+_PINNED = {}
+
+class Verifier(object):
+    """
+    Verifies compact tokens on a pool of workers.
+
+    ``key`` is the key every token is verified against, or a resolver as
+    ``jws.verify_many`` takes, such as a ``KeyStore``. ``executor`` is
+    ``None`` to verify inline, ``'thread'`` for a thread pool (fine for HMAC,
+    where hashlib releases the GIL on large inputs) or ``'process'`` for a
+    process pool (for RSA and ECDSA, which hold it).
+
+    A process pool gets the key once, when each worker starts, and looks it up
+    by fingerprint, so tasks only carry tokens; ``Crypto`` and
+    ``cryptography`` keys travel as their DER export. ``context`` is the
+    ``multiprocessing`` context to start the pool with, such as
+    ``multiprocessing.get_context('spawn')``. Resolvers do not travel to
+    other processes, with one exception: a ``KeyStore`` made with
+    ``KeyStore.from_file``, which each worker loads from the file again.
+    Other resolvers raise ``TypeError`` with ``executor='process'``. At most
+    ``max_pending`` chunks of ``chunk_size`` tokens are in flight at a time.
+    """
+    def __init__(self, key, executor=None, workers=None, max_pending=None, chunk_size=64, context=None):
+        self.chunk_size = chunk_size
+        self._pool = None
+        # what a task names its key by: the key itself in this process, its
+        # fingerprint in another one
+        self._task_key = (key, None)
+        if executor is None:
+            return
+        if executor == 'thread':
+            from multiprocessing.pool import ThreadPool
+            self._pool = ThreadPool(workers)
+        elif executor == 'process':
+            import multiprocessing
+            if isinstance(key, KeyStore) and key.path is not None:
+                (fingerprint, portable) = ('jwks:' + key.path, _StoreFile(key))
+            elif callable(key):
+                raise TypeError("executor='process' cannot send a resolver to its workers; pass a key, "
+                                "a KeyStore made with KeyStore.from_file, or use executor='thread'")
+            else:
+                (fingerprint, portable) = (key_fingerprint(key), _portable(key))
+            self._pool = (context or multiprocessing).Pool(workers, _pin, ({fingerprint: portable},))
+            self._task_key = (None, fingerprint)
+        else:
+            raise ValueError("executor must be None, 'thread' or 'process' (given %r)" % (executor,))
+        self.max_pending = max_pending or 2 * (workers or _cpu_count())
+
+    def verify(self, token):
+        """Verify a single token, returning its ``jws.Result``."""
+        return next(self.verify_many([token]))
+
+    def verify_many(self, tokens):
+        """
+        Yield a ``jws.Result`` for each token in input order. Tokens are read
+        from the iterable only as fast as results are consumed.
+        """
+        chunks = (self._task_key + (chunk,) for chunk in _chunks(tokens, self.chunk_size))
+        if self._pool is None:
+            results = (_verify_chunk(chunk) for chunk in chunks)
+        else:
+            results = imap_bounded(self._pool, _verify_chunk, chunks, self.max_pending)
+        for chunk in results:
+            for result in chunk:
+                yield result
+
+    def close(self):
+        """Stop the workers once the queued work is finished."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def terminate(self):
+        """Stop the workers immediately, dropping queued work."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.close()
+        else:
+            self.terminate()
+
+def imap_bounded(pool, func, iterable, max_pending):
+    """
+    Like ``pool.imap`` but never has more than ``max_pending`` tasks queued,
+    so a large or endless ``iterable`` is consumed at the pace of the caller.
+    """
+    pending = deque()
+    for item in iterable:
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (item,)))
+    while pending:
+        yield pending.popleft().get()
+
+def _pin(pinned):
+    for (fingerprint, key) in pinned.items():
+        if isinstance(key, (_DER, _StoreFile)):
+            key = key.load()
+        _PINNED[fingerprint] = key
+
+class _DER(object):
+    # a ``Crypto`` or ``cryptography`` key on its way to another process as
+    # its DER export; the key objects do not pickle
+    def __init__(self, key):
+        if hasattr(key, 'exportKey'):
+            (self.kind, self.der) = ('Crypto', key.exportKey('DER'))
+        else:
+            (self.kind, self.der) = ('cryptography', cryptography_der(key))
+
+    def load(self):
+        # through ``KEY_CACHE``, so a process given the same key again parses it once
+        return cached_key(self.der, ('DER', self.kind), self._parse)
+
+    def _parse(self, der):
+        if self.kind == 'Crypto':
+            import Crypto.PublicKey.RSA as RSA
+            return RSA.importKey(der)
+        from .openssl import _load_der
+        return _load_der(der)
+
+class _StoreFile(object):
+    # a ``KeyStore`` on its way to a worker, which loads the file itself
+    def __init__(self, store):
+        self.args = (store.path, store.reload_interval, store.warm)
+
+    def load(self):
+        return KeyStore.from_file(*self.args)
+
+def _portable(key):
+    if hasattr(key, 'exportKey') or hasattr(key, 'private_bytes') or hasattr(key, 'public_bytes'):
+        return _DER(key)
+    return key
+
+def _verify_chunk(task):
+    (key, fingerprint, tokens) = task
+    if fingerprint is not None:
+        key = _PINNED[fingerprint]
+    return list(jws.verify_many(tokens, key))
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _cpu_count():
+    import multiprocessing
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
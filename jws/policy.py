@@ -0,0 +1,108 @@
+from __future__ import absolute_import
+
+import re
+import threading
+import time
+
+from .exceptions import (AlgorithmNotAllowed, MalformedToken, TokenExpired, TokenIssuedInFuture,
+                         TokenNotYetValid, TokenTooLarge)
+
+_SIGNING_INPUT = re.compile(b'[A-Za-z0-9_-]*\\.[A-Za-z0-9_-]*\\Z')
+_SEGMENT = re.compile(b'[A-Za-z0-9_-]*\\Z')
+
+class Policy(object):
+    """
+    Checks that turn a token away before any key is parsed or signature
+    checked. Pass one as ``policy`` to ``jws.decode`` or ``jws.verify_many``.
+    In order, before anything else is decoded:
+
+    * ``max_token_length`` and ``max_segment_length``: sizes in bytes,
+    * ``check_alphabet``: every segment is base64url without padding,
+
+    then, on the decoded header and before routing:
+
+    * ``algorithms``: the ``alg`` values allowed,
+
+    then, on a payload that is a claims object:
+
+    * ``exp``, ``nbf`` and (``check_iat``) ``iat``, numbers of seconds since
+      the epoch, give or take ``leeway`` seconds; with ``max_age``, tokens
+      issued longer ago than that are expired too.
+
+    Each reject raises a subclass of ``TokenRejected`` and is counted in
+    ``rejected``, by exception name.
+    """
+    def __init__(self, max_token_length=None, max_segment_length=None, check_alphabet=True, algorithms=None,
+                 check_exp=True, check_nbf=True, check_iat=True, max_age=None, leeway=0, clock=time.time):
+        self.max_token_length = max_token_length
+        self.max_segment_length = max_segment_length
+        self.check_alphabet = check_alphabet
+        self.algorithms = frozenset(algorithms) if algorithms is not None else None
+        self.check_exp = check_exp
+        self.check_nbf = check_nbf
+        self.check_iat = check_iat
+        self.max_age = max_age
+        self.leeway = leeway
+        self.clock = clock
+        self.rejected = {}
+        self._lock = threading.Lock()
+
+    def check_size(self, token):
+        """Before the token is split: its length."""
+        if self.max_token_length is not None and len(token) > self.max_token_length:
+            self.reject(TokenTooLarge("Token is %d bytes, more than %d" % (len(token), self.max_token_length)))
+
+    def check_segments(self, signing_input, head_input, payload_input, encoded_signature):
+        """Before anything is decoded: segment lengths and the alphabet."""
+        if self.max_segment_length is not None:
+            longest = max(len(head_input), len(payload_input), len(encoded_signature))
+            if longest > self.max_segment_length:
+                self.reject(TokenTooLarge("A segment is %d bytes, more than %d" % (longest, self.max_segment_length)))
+        if self.check_alphabet:
+            if not _SIGNING_INPUT.match(signing_input) or not _SEGMENT.match(encoded_signature):
+                self.reject(MalformedToken("Token segments must be base64url without padding"))
+
+    def check_header(self, head):
+        """Before the header is processed: the ``alg``."""
+        error = self.header_error(head)
+        if error is not None:
+            self.reject(error)
+
+    def header_error(self, head):
+        """What ``check_header`` would raise, without counting it, or None."""
+        if self.algorithms is not None:
+            alg = head.get('alg') if isinstance(head, dict) else None
+            if alg not in self.algorithms:
+                return AlgorithmNotAllowed("Algorithm %r is not allowed" % (alg,))
+        return None
+
+    def check_claims(self, payload):
+        """Before the signature is checked: the time claims, if any."""
+        if not isinstance(payload, dict):
+            return
+        now = self.clock()
+        if self.check_exp and 'exp' in payload:
+            if now >= self._time(payload, 'exp') + self.leeway:
+                self.reject(TokenExpired("Token expired"))
+        if self.check_nbf and 'nbf' in payload:
+            if now < self._time(payload, 'nbf') - self.leeway:
+                self.reject(TokenNotYetValid("Token is not valid yet"))
+        if (self.check_iat or self.max_age is not None) and 'iat' in payload:
+            issued = self._time(payload, 'iat')
+            if self.check_iat and now < issued - self.leeway:
+                self.reject(TokenIssuedInFuture("Token was issued in the future"))
+            if self.max_age is not None and now > issued + self.max_age + self.leeway:
+                self.reject(TokenExpired("Token is older than %s seconds" % self.max_age))
+
+    def reject(self, error):
+        """Count ``error`` and raise it."""
+        with self._lock:
+            name = error.__class__.__name__
+            self.rejected[name] = self.rejected.get(name, 0) + 1
+        raise error
+
+    def _time(self, payload, claim):
+        value = payload[claim]
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            self.reject(MalformedToken("Claim %s must be a number" % claim))
+        return value
@@ -0,0 +1,117 @@
+from __future__ import absolute_import
+
+import jws
+import jws.utils as utils
+
+# bytes read at a time when a payload is given as a file
+CHUNK_SIZE = 64 * 1024
+
+class Signer(object):
+    """
+    Signs a payload given in pieces, for payloads too large to hold in memory.
+
+        >>> signer = jws.Signer({'alg': 'HS256'}, 'secret')
+        >>> for chunk in chunks:
+        ...     signer.update(chunk)
+        >>> signature = signer.finalize()
+
+    The payload is raw bytes, not JSON. It is base64url encoded on the fly
+    unless the header has ``"b64": false`` (RFC 7797), in which case it is
+    signed as it is. Either way the pieces go straight into the algorithm's
+    hash, so memory use does not grow with the payload. Algorithms without
+    ``new_hash`` support (custom ones, usually) get the whole message at
+    ``finalize`` instead. ``codec`` is the JSON codec for the header, as in
+    ``jws.utils.get_codec``.
+    """
+    def __init__(self, head, key=None, codec=None):
+        self.head_input = utils.encode(head, codec)
+        self._start(head, self.head_input, key, 'sign')
+
+    def update(self, chunk):
+        """Add the next piece of the payload."""
+        chunk = utils.to_bytes_2and3(chunk)
+        if self._b64:
+            if self._pending:
+                chunk = b''.join((self._pending, chunk))
+            cut = len(chunk) - len(chunk) % 3
+            self._pending = bytes(chunk[cut:])
+            chunk = utils.base64url_encode(memoryview(chunk)[:cut])
+        self._feed(chunk)
+        return self
+
+    def feed(self, source):
+        """Add a whole payload from a file-like object or an iterable of pieces."""
+        for chunk in _pieces(source):
+            self.update(chunk)
+        return self
+
+    def finalize(self):
+        """Return the base64url encoded signature. The signer can't be reused."""
+        return utils.to_base64(self._finish('sign'))
+
+    def _start(self, head, head_input, key, step):
+        data = jws._process(head, None, key, step, unencoded=True)
+        algorithm = data.get('algorithm') or {}
+        self._key = data['key']
+        self._b64 = data.get('b64', True)
+        self._pending = b''
+        if 'new_hash' in algorithm and step + '_hash' in algorithm:
+            self._hash = algorithm['new_hash'](self._key)
+            self._feed = self._hash.update
+            self._done = algorithm[step + '_hash']
+        else:
+            self._hash = []
+            self._feed = self._hash.append
+            self._done = data[jws.STEPS[step]]
+        self._feed(utils.to_bytes_2and3(head_input))
+        self._feed(b'.')
+
+    def _finish(self, step, *args):
+        if self._hash is None:
+            raise ValueError("finalize() was already called")
+        if self._pending:
+            self._feed(utils.base64url_encode(self._pending))
+        (message, self._hash) = (self._hash, None)
+        if isinstance(message, list):
+            message = b''.join(message)
+        return self._done(message, *(args + (self._key,)))
+
+class _DetachedVerifier(Signer):
+    def __init__(self, head_input, key=None, codec=None):
+        self.header = utils.decode(head_input, codec)
+        self._start(self.header, head_input, key, 'verify')
+
+    def verify(self, signature):
+        return self._finish('verify', signature)
+
+def sign_detached(head, payload, key=None, codec=None):
+    """
+    Sign a payload given as a file-like object or an iterable of pieces and
+    return a compact token with the payload left out: ``header..signature``.
+    """
+    signer = Signer(head, key, codec).feed(payload)
+    return '%s..%s' % (jws._text(signer.head_input), jws._text(signer.finalize()))
+
+def verify_detached(token, payload, key=None, codec=None):
+    """
+    Verify a ``header..signature`` token against a payload given as a
+    file-like object or an iterable of pieces. Returns the decoded header.
+    """
+    (head_input, empty, encoded_signature) = jws._text(token).split('.')
+    if empty:
+        raise ValueError("A detached token has an empty payload segment")
+    verifier = _DetachedVerifier(head_input, key, codec).feed(payload)
+    verifier.verify(utils.from_base64(encoded_signature))
+    return verifier.header
+
+def _pieces(source):
+    read = getattr(source, 'read', None)
+    if read is None:
+        for chunk in source:
+            yield chunk
+        return
+    while True:
+        chunk = read(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
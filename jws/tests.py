@@ -1,9 +1,16 @@
+import traceback
 import unittest
 import jws
+import jws.cli
 import ecdsa
 import hashlib
 import Crypto.PublicKey.RSA as rsa
 
+try:
+    import cryptography
+except ImportError:
+    cryptography = None
+
 class TestJWS_helpers(unittest.TestCase):
     def test_default_algorithm_finding(self):
         names = [('ES256', jws.algos.ECDSA),       ('ES384', jws.algos.ECDSA),       ('ES512', jws.algos.ECDSA),
@@ -15,6 +22,18 @@ class TestJWS_helpers(unittest.TestCase):
         # Python 3+ support (no tuple unpacking)
         map(lambda name_fn: self.assertIn(name_fn[1], jws.algos.find(name_fn[0])), names)
 
+    def test_import_is_light(self):
+        import os, subprocess, sys
+        # a fresh interpreter, so nothing is imported already
+        code = ("import sys, time; start = time.time(); import jws; "
+                "print(time.time() - start); print(' '.join(sys.modules))")
+        root = os.path.dirname(os.path.dirname(os.path.abspath(jws.__file__)))
+        (took, modules) = subprocess.check_output([sys.executable, '-c', code], cwd=root).decode().splitlines()
+        self.assertTrue(float(took) < 0.25, 'import jws took %ss' % took)
+        loaded = set(name.split('.')[0] for name in modules.split())
+        for backend in ('ecdsa', 'Crypto', 'cryptography', 'asyncio', 'multiprocessing'):
+            self.assertNotIn(backend, loaded)
+
     def test_bad_algorithm_route(self):
         self.assertRaises(jws.algos.RouteMissingError, jws.algos.route, 'f7u12')
 
@@ -23,6 +42,86 @@ class TestJWS_helpers(unittest.TestCase):
         self.assertTrue(callable(resolved['sign']))
         self.assertTrue(callable(resolved['verify']))
 
+    def test_route_is_cached(self):
+        self.assertIs(jws.algos.route('HS256'), jws.algos.route('HS256'))
+        self.assertIsNot(jws.algos.route('HS256'), jws.algos.route('HS384'))
+
+    def test_route_cache_follows_custom(self):
+        class Custom(jws.algos.AlgorithmBase):
+            def sign(self, msg, key): return 'custom'
+            def verify(self, msg, sig, key): return True
+        original = jws.algos.CUSTOM
+        try:
+            default = jws.algos.route('HS256')
+            jws.algos.CUSTOM = [(r'^HS256$', Custom)]
+            self.assertEqual(jws.algos.route('HS256')['sign']('msg', 'key'), 'custom')
+            jws.algos.CUSTOM = []
+            self.assertRaises(jws.algos.RouteMissingError, jws.algos.route, 'C256')
+            jws.algos.CUSTOM.append((r'^C256$', Custom))
+            self.assertEqual(jws.algos.route('C256')['sign']('msg', 'key'), 'custom')
+            self.assertEqual(jws.algos.route('HS256')['sign']('msg', 'key'), default['sign']('msg', 'key'))
+        finally:
+            jws.algos.CUSTOM = original
+
+    def test_bytes_pipeline(self):
+        data = b'abcdefgh'
+        view = memoryview(data)
+        self.assertIs(jws.utils.to_bytes_2and3(data), data)
+        self.assertIs(jws.utils.to_bytes_2and3(view), view)
+        for n in range(len(data)):
+            encoded = jws.utils.base64url_encode(data[:n])
+            self.assertNotIn(b'=', encoded)
+            self.assertEqual(jws.utils.base64url_decode(encoded), data[:n])
+            self.assertEqual(jws.utils.base64url_decode(memoryview(encoded)), data[:n])
+        self.assertEqual(jws._signing_input({'a': 1}, {'b': 2}),
+                         jws.utils.encode({'a': 1}) + b'.' + jws.utils.encode({'b': 2}))
+
+    def test_json_codecs(self):
+        import json
+        claims = {'b': [1, 2], 'a': 'x'}
+        self.assertEqual(jws.utils.to_json(claims), json.dumps(claims))
+        compact = (lambda a: json.dumps(a, separators=(',', ':'), sort_keys=True).encode('utf8'), json.loads)
+        jws.utils.register_codec('compact', *compact)
+        self.assertEqual(jws.utils.encode(claims, 'compact'), jws.utils.to_base64(b'{"a":"x","b":[1,2]}'))
+        self.assertEqual(jws.utils.encode(claims, compact), jws.utils.encode(claims, 'compact'))
+        self.assertEqual(jws.utils.decode(jws.utils.encode(claims, 'compact')), claims)
+        try:
+            jws.utils.set_codec('compact')
+            self.assertEqual(jws.utils.encode(claims), jws.utils.encode(claims, 'compact'))
+        finally:
+            jws.utils.set_codec('json')
+        self.assertEqual(jws.utils.encode(claims), jws.utils.to_base64(json.dumps(claims)))
+        self.assertRaises(KeyError, jws.utils.set_codec, 'nope')
+
+    def test_constant_time_compare(self):
+        compare = jws.utils.constant_time_compare
+        self.assertTrue(compare(b'abc', b'abc'))
+        self.assertTrue(compare('abc', 'abc'))
+        self.assertTrue(compare('abc', b'abc'))
+        self.assertTrue(compare(u'\xe9', u'\xe9'.encode('utf8')))
+        self.assertFalse(compare(b'abc', b'abd'))
+        self.assertFalse(compare(b'abc', b'abcd'))
+        self.assertFalse(compare(b'', b'a'))
+
+    def test_constant_time_compare_timing(self):
+        import time
+        size = 1 << 20
+        secret = b'a' * size
+        early = b'b' + b'a' * (size - 1)
+        late = b'a' * (size - 1) + b'b'
+        def fastest(other):
+            best = None
+            for _ in range(50):
+                start = time.time()
+                jws.utils.constant_time_compare(secret, other)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            return best
+        (early_time, late_time) = (fastest(early), fastest(late))
+        # a short-circuiting compare would be orders of magnitude apart here
+        self.assertTrue(late_time < early_time * 3 + 1e-5, (early_time, late_time))
+        self.assertTrue(early_time < late_time * 3 + 1e-5, (early_time, late_time))
+
     def test_header_algo_find(self):
         data = {'header': {'alg': 'ES256'}}
         jws.header.process(data, 'sign')
@@ -51,6 +150,62 @@ class TestJWS_helpers(unittest.TestCase):
         jws.header.process(data, 'sign')
         self.assertEqual(data['key'], 'somethingelse')
 
+    def test_header_outcome_is_remembered(self):
+        made = []
+        class Counting(jws.header.GenericString):
+            cacheable = True
+            def __init__(self, *args):
+                made.append(args[0])
+                jws.header.GenericString.__init__(self, *args)
+        original = jws.header.KNOWN_HEADERS['typ']
+        jws.header.KNOWN_HEADERS['typ'] = Counting
+        try:
+            for n in range(3):
+                data = {'header': {'alg': 'HS256', 'typ': 'JWT'}}
+                jws.header.process(data, 'sign')
+                self.assertTrue(callable(data['signer']))
+            self.assertEqual(made, ['typ'])
+            jws.header.process({'header': {'alg': 'HS256', 'typ': 'JWT'}}, 'verify')
+            self.assertEqual(made, ['typ', 'typ'])
+        finally:
+            jws.header.KNOWN_HEADERS['typ'] = original
+        # handlers that are not cacheable, like kid, still run every time
+        store = jws.KeyStore()
+        store.add('one', kid='k')
+        for n in range(2):
+            data = {'header': {'alg': 'HS256', 'kid': 'k'}, 'keystore': store, 'key': None}
+            jws.header.process(data, 'verify')
+            self.assertEqual(data['key'], 'one')
+        store.add('two', kid='k')
+        data = {'header': {'alg': 'HS256', 'kid': 'k'}, 'keystore': store, 'key': None}
+        jws.header.process(data, 'verify')
+        self.assertEqual(data['key'], 'two')
+
+    def test_header_cacheable_is_not_inherited(self):
+        # a subclass of a cacheable handler that reads the key
+        class Scoped(jws.header.GenericString):
+            def verify(self):
+                self.data['scoped'] = (self.value, self.data['key'])
+                return self.value
+        jws.header.KNOWN_HEADERS['scope'] = Scoped
+        try:
+            for key in ('one', 'two', 'three'):
+                data = {'header': {'alg': 'HS256', 'scope': 'a'}, 'key': key}
+                jws.header.process(data, 'verify')
+                self.assertEqual(data['scoped'], ('a', key))
+        finally:
+            del jws.header.KNOWN_HEADERS['scope']
+
+    def test_header_memo_keeps_values_apart(self):
+        data = {'header': {'alg': 'HS256', 'b64': False, 'crit': ['b64']}}
+        jws.header.process(data, 'sign')
+        self.assertIs(data['b64'], False)
+        data = {'header': {'alg': 'HS256', 'b64': 0, 'crit': ['b64']}}
+        jws.header.process(data, 'sign')
+        self.assertIs(data['b64'], 0)
+        self.assertRaises(jws.header.ParameterNotUnderstood, jws.header.process,
+                          {'header': {'alg': 'HS256', 'crit': ['b64']}}, 'sign')
+
     def test_custom_algorithm(self):
         class F7U12(jws.algos.AlgorithmBase):
             def __init__(self): pass
@@ -104,6 +259,50 @@ class TestJWS_ecdsa(unittest.TestCase):
         self.assertTrue(len(sig) > 0)
         self.assertTrue(jws.verify(header, self.payload, sig, key.get_verifying_key()))
 
+    def test_string_key_cache(self):
+        header = {'alg': 'ES256'}
+        sig = jws.sign(header, self.payload, self.sk256)
+        vk = self.sk256.get_verifying_key().to_string()
+        jws.algos.KEY_CACHE.clear()
+        misses, hits = jws.algos.KEY_CACHE.misses, jws.algos.KEY_CACHE.hits
+        self.assertTrue(jws.verify(header, self.payload, sig, vk))
+        self.assertTrue(jws.verify(header, self.payload, sig, vk))
+        self.assertEqual(jws.algos.KEY_CACHE.misses, misses + 1)
+        self.assertEqual(jws.algos.KEY_CACHE.hits, hits + 1)
+        # the same material for another curve is a different entry
+        self.assertRaises(Exception, jws.verify, {'alg': 'ES384'}, self.payload, sig, vk)
+
+    def test_warm_up(self):
+        header = {'alg': 'ES256'}
+        sig = jws.sign(header, self.payload, self.sk256)
+        vk = ecdsa.VerifyingKey.from_string(self.sk256.get_verifying_key().to_string(), curve=ecdsa.NIST256p)
+        warm = jws.algos.warm_up(vk)
+        self.assertIs(jws.algos.warm_up(vk), warm)
+        self.assertIs(jws.algos.route('ES256')['prepare_key'](vk), warm)
+        self.assertTrue(jws.verify(header, self.payload, sig, vk))
+        self.assertRaises(jws.SignatureError, jws.verify, header, {'bad': 1}, sig, vk)
+        # or through the algorithm, which parses strings first
+        material = ecdsa.SigningKey.generate(ecdsa.NIST256p).get_verifying_key().to_string()
+        ES256 = jws.algos.ECDSA(256)
+        self.assertIs(ES256.prepare_key(material, warm=True), ES256.prepare_key(material))
+        # signing keys already have their tables
+        self.assertIs(jws.algos.warm_up(self.sk256), self.sk256)
+
+    def test_warm_keys_memory_cap(self):
+        saved = jws.algos.WARM_KEYS
+        # room for the tables of one P-256 key
+        jws.algos.WARM_KEYS = jws.algos.LRUCache(10, 256 * jws.algos.TABLE_BYTES_PER_BIT, saved.sizeof)
+        try:
+            (one, two) = [ecdsa.SigningKey.generate(ecdsa.NIST256p).get_verifying_key() for _ in range(2)]
+            jws.algos.warm_up(one)
+            jws.algos.warm_up(two)
+            prepare = jws.algos.route('ES256')['prepare_key']
+            self.assertIs(prepare(one), one)
+            self.assertIsNot(prepare(two), two)
+            self.assertEqual(jws.algos.WARM_KEYS.evictions, 1)
+        finally:
+            jws.algos.WARM_KEYS = saved
+
     def test_invalid_ecdsa_decode(self):
         header = {'alg': 'ES256'}
         sig = jws.sign(header, self.payload, self.sk256)
@@ -114,6 +313,853 @@ class TestJWS_ecdsa(unittest.TestCase):
         self.assertRaises(jws.SignatureError, jws.verify, header, {'bad':1}, sig, badkey)
 
 
+class TestJWS_compact(unittest.TestCase):
+    sk256 = ecdsa.SigningKey.generate(ecdsa.NIST256p)
+
+    def test_encode_decode(self):
+        header = {'alg': 'ES256', 'typ': 'JWT'}
+        payload = {'iss': 'brianb', 'claim': 'JSON is the raddest.'}
+        token = jws.encode(header, payload, self.sk256)
+        vk = self.sk256.get_verifying_key()
+        self.assertEqual(jws.decode(token, vk), (header, payload))
+        (head, claim, sig) = token.split('.')
+        self.assertTrue(jws.verify(header, payload, sig, vk))
+
+    def test_decode_uses_received_segments(self):
+        # a header that json.dumps would never produce must still verify
+        head = jws.utils.to_base64('{"alg":   "ES256"}').decode('ascii')
+        claim = jws.utils.encode({'a': 1}).decode('ascii')
+        sig = jws.utils.to_base64(jws.algos.route('ES256')['sign']('%s.%s' % (head, claim), self.sk256))
+        token = '%s.%s.%s' % (head, claim, sig.decode('ascii'))
+        self.assertEqual(jws.decode(token, self.sk256.get_verifying_key()), ({'alg': 'ES256'}, {'a': 1}))
+        self.assertEqual(jws.decode(token.encode('ascii'), self.sk256.get_verifying_key())[1], {'a': 1})
+
+    def test_encode_with_codec(self):
+        import json
+        dumps = lambda a: json.dumps(a, separators=(',', ':')).encode('utf8')
+        token = jws.encode({'alg': 'ES256'}, {'a': 1}, self.sk256, codec=(dumps, json.loads))
+        self.assertEqual(token.split('.')[1], jws.utils.to_base64(b'{"a":1}').decode('ascii'))
+        self.assertEqual(jws.decode(token, self.sk256.get_verifying_key())[1], {'a': 1})
+        (head, claim, sig) = token.split('.')
+        self.assertTrue(jws.verify({'alg': 'ES256'}, {'a': 1}, sig, self.sk256.get_verifying_key(),
+                                   codec=(dumps, json.loads)))
+
+    def test_decode_errors(self):
+        token = jws.encode({'alg': 'ES256'}, {'a': 1}, self.sk256)
+        vk = self.sk256.get_verifying_key()
+        (head, claim, sig) = token.split('.')
+        forged = '.'.join([head, jws.utils.encode({'a': 2}).decode('ascii'), sig])
+        self.assertRaises(jws.SignatureError, jws.decode, forged, vk)
+        self.assertRaises(ValueError, jws.decode, head + '.' + sig, vk)
+
+
+class TestJWS_stream(unittest.TestCase):
+    sk256 = ecdsa.SigningKey.generate(ecdsa.NIST256p)
+    private = rsa.generate(2048)
+    payload = b'0123456789' * 1000
+
+    def chunks(self, size=7):
+        return [self.payload[i:i + size] for i in range(0, len(self.payload), size)]
+
+    def test_signer_matches_sign(self):
+        header = {'alg': 'RS256'}
+        signer = jws.Signer(header, self.private)
+        for chunk in self.chunks():
+            signer.update(chunk)
+        signature = signer.finalize()
+        self.assertRaises(ValueError, signer.finalize)
+        expected = jws.algos.route('RS256')['sign'](
+            jws.utils.encode(header) + b'.' + jws.utils.to_base64(self.payload), self.private)
+        self.assertEqual(jws.utils.from_base64(signature), expected)
+
+    def test_detached_round_trip(self):
+        import io
+        vk = self.sk256.get_verifying_key()
+        for header in ({'alg': 'ES256'}, {'alg': 'ES256', 'b64': False, 'crit': ['b64']}):
+            token = jws.sign_detached(header, io.BytesIO(self.payload), self.sk256)
+            self.assertIn('..', token)
+            self.assertEqual(jws.verify_detached(token, self.chunks(13), vk), header)
+            self.assertRaises(jws.SignatureError, jws.verify_detached, token, [self.payload, b'!'], vk)
+
+    def test_unencoded_signing_input(self):
+        header = {'alg': 'PS256', 'b64': False, 'crit': ['b64']}
+        token = jws.sign_detached(header, self.chunks(), self.private)
+        (head, _, sig) = token.split('.')
+        crypt = jws.algos.route('PS256')
+        msg = head.encode('ascii') + b'.' + self.payload
+        self.assertTrue(crypt['verify'](msg, jws.utils.from_base64(sig), self.private.publickey()))
+
+    def test_custom_algorithm_falls_back_to_buffering(self):
+        class Echo(jws.algos.AlgorithmBase):
+            def sign(self, msg, key): return msg
+            def verify(self, msg, sig, key): return msg == sig
+        original = jws.algos.CUSTOM
+        try:
+            jws.algos.CUSTOM = [('^ECHO$', Echo)]
+            signature = jws.Signer({'alg': 'ECHO'}, 'k').feed(self.chunks()).finalize()
+            self.assertEqual(jws.utils.from_base64(signature).split(b'.')[1], jws.utils.to_base64(self.payload))
+        finally:
+            jws.algos.CUSTOM = original
+
+    def test_b64_header_rules(self):
+        self.assertRaises(jws.ParameterNotUnderstood, jws.Signer, {'alg': 'ES256', 'b64': False}, self.sk256)
+        self.assertRaises(jws.ParameterNotUnderstood, jws.Signer, {'alg': 'ES256', 'crit': ['nope']}, self.sk256)
+        self.assertRaises(jws.ParameterNotImplemented, jws.sign,
+                          {'alg': 'ES256', 'b64': False, 'crit': ['b64']}, {}, self.sk256)
+
+
+@unittest.skipUnless(cryptography, 'needs the cryptography package')
+class TestJWS_openssl(unittest.TestCase):
+    private = rsa.generate(2048)
+    curves = {'256': ecdsa.NIST256p, '384': ecdsa.NIST384p, '512': ecdsa.NIST521p}
+
+    def tearDown(self):
+        jws.algos.set_backend('default')
+
+    def keys(self, alg):
+        if alg.startswith('ES'):
+            sk = ecdsa.SigningKey.generate(self.curves[alg[2:]])
+            return (sk, sk.get_verifying_key())
+        return (self.private, self.private.publickey())
+
+    def test_backends_interoperate(self):
+        for alg in ['%s%d' % (family, bits) for family in ('RS', 'PS', 'ES') for bits in (256, 384, 512)]:
+            (sk, vk) = self.keys(alg)
+            for (signing, verifying) in (('default', 'cryptography'), ('cryptography', 'default')):
+                jws.algos.set_backend(signing)
+                token = jws.encode({'alg': alg}, {'n': 1}, sk)
+                jws.algos.set_backend(verifying)
+                self.assertEqual(jws.decode(token, vk), ({'alg': alg}, {'n': 1}))
+                self.assertRaises(jws.SignatureError, jws.decode, token[:-6] + 'AAAAAA', vk)
+
+    def test_routes_and_keys(self):
+        from jws import openssl
+        jws.algos.set_backend('cryptography')
+        self.assertIs(jws.algos.find('ES256')[0], openssl.ECDSA)
+        (sk, vk) = self.keys('ES256')
+        es256 = jws.algos.route('ES256')
+        self.assertIs(es256['prepare_key'](vk), es256['prepare_key'](vk))
+        token = jws.encode({'alg': 'ES256'}, {'n': 1}, sk)
+        self.assertEqual(jws.decode(token, vk.to_string())[1], {'n': 1})
+        token = jws.encode({'alg': 'RS256'}, {'n': 1}, self.private.exportKey())
+        self.assertEqual(jws.decode(token, self.private.publickey().exportKey())[1], {'n': 1})
+        # streaming goes through new_hash and sign_hash
+        detached = jws.sign_detached({'alg': 'PS384'}, [b'a', b'b'], self.private)
+        jws.algos.set_backend('default')
+        self.assertEqual(jws.verify_detached(detached, [b'ab'], self.private.publickey()), {'alg': 'PS384'})
+        self.assertRaises(ValueError, jws.algos.set_backend, 'nope')
+
+    def test_native_keys(self):
+        from cryptography.hazmat.primitives.asymmetric import ec, rsa as native_rsa
+        jws.algos.set_backend('cryptography')
+        for (alg, sk) in (('ES256', ec.generate_private_key(ec.SECP256R1())),
+                          ('RS256', native_rsa.generate_private_key(65537, 2048))):
+            vk = sk.public_key()
+            fingerprint = jws.algos.key_fingerprint(vk)
+            self.assertEqual(fingerprint, jws.algos.key_fingerprint(sk.public_key()))
+            self.assertNotEqual(fingerprint, jws.algos.key_fingerprint(sk))
+            token = jws.encode({'alg': alg}, {'n': 1}, sk)
+            cache = jws.VerificationCache()
+            for _ in range(2):
+                self.assertEqual(jws.decode(token, vk, cache=cache)[1], {'n': 1})
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            with jws.Verifier(vk, executor='process', workers=1) as verifier:
+                self.assertTrue(verifier.verify(token).ok)
+
+
+class TestJWS_multi(unittest.TestCase):
+    sk256 = ecdsa.SigningKey.generate(ecdsa.NIST256p)
+    private = rsa.generate(2048)
+
+    def signers(self):
+        return [({'alg': 'ES256'}, self.sk256), ({'alg': 'HS256'}, 'secret', {'kid': 'hmac'}),
+                ({'alg': 'PS256'}, self.private)]
+
+    def test_round_trip(self):
+        from concurrent.futures import ThreadPoolExecutor
+        import json
+        serialized = jws.sign_multi({'n': 1}, self.signers())
+        self.assertEqual([e['protected'] for e in serialized['signatures']],
+                         [jws.utils.encode(h).decode('ascii') for h in ({'alg': 'ES256'}, {'alg': 'HS256'}, {'alg': 'PS256'})])
+        self.assertEqual(serialized['signatures'][1]['header'], {'kid': 'hmac'})
+        # each signature matches what jws.sign makes for its header
+        self.assertEqual(serialized['signatures'][1]['signature'], jws.sign({'alg': 'HS256'}, {'n': 1}, 'secret').decode('ascii'))
+        keys = {'ES256': self.sk256.get_verifying_key(), 'HS256': 'secret', 'PS256': self.private.publickey()}
+        resolver = lambda header: keys[header['alg']]
+        with ThreadPoolExecutor(3) as executor:
+            self.assertEqual(jws.sign_multi({'n': 1}, self.signers(), executor=executor)['payload'], serialized['payload'])
+            for run_on in (None, executor):
+                (payload, headers) = jws.verify_multi(json.dumps(serialized), resolver, executor=run_on)
+                self.assertEqual(payload, {'n': 1})
+                self.assertEqual([h['alg'] for h in headers], ['ES256', 'HS256', 'PS256'])
+                self.assertEqual(headers[1]['kid'], 'hmac')
+
+    def test_policies(self):
+        serialized = jws.sign_multi({'n': 1}, self.signers())
+        checked = []
+        def resolver(header):
+            checked.append(header['alg'])
+            return 'secret' if header['alg'] == 'HS256' else 'wrong'
+        self.assertRaises(Exception, jws.verify_multi, serialized, resolver)
+        self.assertEqual(checked, ['ES256'])
+        del checked[:]
+        (payload, headers) = jws.verify_multi(serialized, resolver, policy='any')
+        self.assertEqual([h['alg'] for h in headers], ['HS256'])
+        self.assertEqual(checked, ['ES256', 'HS256'])
+        self.assertRaises(jws.SignatureError, jws.verify_multi, serialized, 'nope', policy='any')
+        self.assertRaises(ValueError, jws.verify_multi, serialized, 'secret', policy='most')
+
+    def test_flattened_and_header_rules(self):
+        serialized = jws.sign_multi({'n': 1}, [({'alg': 'HS256'}, 'secret')])
+        flattened = dict(serialized['signatures'][0], payload=serialized['payload'])
+        self.assertEqual(jws.verify_multi(flattened, 'secret'), ({'n': 1}, [{'alg': 'HS256'}]))
+        self.assertRaises(jws.ParameterNotUnderstood, jws.sign_multi, {}, [({'alg': 'HS256'}, 'secret', {'alg': 'HS384'})])
+
+
+class TestJWS_cli(unittest.TestCase):
+    sk256 = ecdsa.SigningKey.generate(ecdsa.NIST256p)
+
+    def run_cli(self, argv, lines):
+        import io, json
+        (stdout, stderr) = (io.StringIO(), io.StringIO())
+        status = jws.cli.main(argv, io.StringIO(u''.join(line + u'\n' for line in lines)), stdout, stderr)
+        return (status, [json.loads(line) for line in stdout.getvalue().splitlines()], stderr.getvalue())
+
+    def test_sign_then_verify(self):
+        (status, signed, summary) = self.run_cli(['sign', '--secret', 'secret', '--header', '{"alg": "HS256"}'],
+                                                 ['{"n": 1}', '', 'nope', '{"n": 2}'])
+        self.assertEqual(status, 1)
+        self.assertEqual([r['ok'] for r in signed], [True, False, True])
+        # the blank line is skipped
+        self.assertIn('3 records, 2 ok, 1 failed', summary)
+        (head, payload, signature) = signed[0]['token'].split('.')
+        forged = '.'.join((head, payload, ('B' if signature[0] == 'A' else 'A') + signature[1:]))
+        tokens = [signed[0]['token'], signed[2]['token'], forged]
+        (status, verified, summary) = self.run_cli(['verify', '--secret', 'secret'], [tokens[0]] + [
+            '{"token": "%s"}' % token for token in tokens[1:]])
+        self.assertEqual([(r['ok'], r.get('payload')) for r in verified], [(True, {'n': 1}), (True, {'n': 2}), (False, None)])
+        self.assertTrue(verified[2]['error'].startswith('SignatureError'))
+        self.assertIn('(SignatureError: 1)', summary)
+
+    def test_workers_and_key_files(self):
+        import os, shutil, tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            (private, public) = (os.path.join(directory, 'ec.pem'), os.path.join(directory, 'ec.pub.pem'))
+            with open(private, 'wb') as f:
+                f.write(self.sk256.to_pem())
+            with open(public, 'wb') as f:
+                f.write(self.sk256.get_verifying_key().to_pem())
+            claims = ['{"n": %d}' % n for n in range(20)]
+            (status, signed, _) = self.run_cli(['sign', '--key', private, '--header', '{"alg": "ES256"}',
+                                                '--workers', '2', '--chunk-size', '3'], claims)
+            self.assertEqual(status, 0)
+            (status, verified, summary) = self.run_cli(['verify', '--key', public, '--workers', '2', '--chunk-size', '3'],
+                                                       [r['token'] for r in signed])
+            self.assertEqual([r['payload']['n'] for r in verified], list(range(20)))
+            self.assertIn('20 records, 20 ok', summary)
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestJWS_policy(unittest.TestCase):
+    sk256 = ecdsa.SigningKey.generate(ecdsa.NIST256p)
+
+    def test_rejects_before_crypto(self):
+        vk = self.sk256.get_verifying_key()
+        policy = jws.Policy(max_token_length=400, max_segment_length=200, algorithms=['ES256'], leeway=10,
+                            max_age=3600, clock=lambda: 1000000)
+        good = jws.encode({'alg': 'ES256'}, {'exp': 1000005, 'iat': 999000}, self.sk256)
+        self.assertEqual(jws.decode(good, vk, policy=policy)[1]['exp'], 1000005)
+        (head, payload, signature) = good.split('.')
+        cases = [
+            (jws.TokenTooLarge, '.'.join((head, payload + 'A' * 400, signature))),
+            (jws.TokenTooLarge, '.'.join((head, 'A' * 250, signature))),
+            (jws.MalformedToken, '.'.join((head, payload + '=', signature))),
+            (jws.MalformedToken, '.'.join((head, payload, signature[:-1] + '+'))),
+            (jws.AlgorithmNotAllowed, jws.encode({'alg': 'HS256'}, {}, 'secret')),
+            (jws.TokenExpired, jws.encode({'alg': 'ES256'}, {'exp': 999990}, self.sk256)),
+            (jws.TokenExpired, jws.encode({'alg': 'ES256'}, {'iat': 990000}, self.sk256)),
+            (jws.TokenNotYetValid, jws.encode({'alg': 'ES256'}, {'nbf': 1000011}, self.sk256)),
+            (jws.TokenIssuedInFuture, jws.encode({'alg': 'ES256'}, {'iat': 1000011}, self.sk256)),
+            (jws.MalformedToken, jws.encode({'alg': 'ES256'}, {'exp': 'soon'}, self.sk256)),
+        ]
+        calls = []
+        original = jws.algos.ECDSA.verify
+        jws.algos.ECDSA.verify = lambda *args: calls.append(args)
+        try:
+            jws.algos.clear_route_cache()
+            for (error, token) in cases:
+                self.assertRaises(error, jws.decode, token, vk, policy=policy)
+                self.assertTrue(issubclass(error, jws.TokenRejected))
+        finally:
+            jws.algos.ECDSA.verify = original
+            jws.algos.clear_route_cache()
+        self.assertEqual(calls, [])
+        self.assertEqual(policy.rejected, {'TokenTooLarge': 2, 'MalformedToken': 3, 'AlgorithmNotAllowed': 1,
+                                           'TokenExpired': 2, 'TokenNotYetValid': 1, 'TokenIssuedInFuture': 1})
+        # leeway lets a just expired token through
+        jws.decode(jws.encode({'alg': 'ES256'}, {'exp': 999995}, self.sk256), vk, policy=policy)
+
+    def test_verify_many(self):
+        policy = jws.Policy(algorithms=['HS256'])
+        tokens = [jws.encode({'alg': 'HS384'}, {'n': n}, 'secret') for n in range(3)]
+        tokens.append(jws.encode({'alg': 'HS256'}, {'exp': 1}, 'secret'))
+        tokens.append(jws.encode({'alg': 'HS256'}, {'n': 4}, 'secret'))
+        results = list(jws.verify_many(tokens, 'secret', policy=policy))
+        self.assertEqual([r.error.__class__.__name__ if r.error else None for r in results],
+                         ['AlgorithmNotAllowed'] * 3 + ['TokenExpired', None])
+        self.assertEqual(policy.rejected, {'AlgorithmNotAllowed': 3, 'TokenExpired': 1})
+        # one error per token, each with a traceback of its own
+        self.assertIsNot(results[0].error, results[2].error)
+        self.assertEqual(len(traceback.extract_tb(results[0].error.__traceback__)),
+                         len(traceback.extract_tb(results[2].error.__traceback__)))
+
+
+class TestJWS_context(unittest.TestCase):
+    sk256 = ecdsa.SigningKey.generate(ecdsa.NIST256p)
+    private = rsa.generate(2048)
+
+    def test_matches_encode(self):
+        header = {'alg': 'HS256', 'typ': 'JWT', 'kid': 'one'}
+        context = jws.SigningContext(header, 'secret')
+        for payload in ({'n': 1}, {'n': 2}, 'text'):
+            self.assertEqual(context.token(payload), jws.encode(header, payload, 'secret'))
+            self.assertEqual(context.sign(payload), jws.sign(header, payload, 'secret'))
+        for (alg, sk, vk) in (('ES256', self.sk256, self.sk256.get_verifying_key()),
+                              ('PS256', self.private, self.private.publickey())):
+            token = jws.SigningContext({'alg': alg}, sk).token({'n': 1})
+            self.assertEqual(jws.decode(token, vk), ({'alg': alg}, {'n': 1}))
+        self.assertRaises(jws.AlgorithmNotImplemented, jws.SigningContext, {'alg': 'f7u12'}, 'secret')
+        self.assertRaises(jws.MissingKey, jws.SigningContext, {'alg': 'HS256'})
+
+    def test_shared_between_threads(self):
+        import threading
+        context = jws.SigningContext({'alg': 'HS512'}, 'secret')
+        (results, errors) = ({}, [])
+        def work(n):
+            try:
+                for i in range(50):
+                    results[(n, i)] = context.token({'n': n, 'i': i})
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        for ((n, i), token) in results.items():
+            self.assertEqual(token, jws.encode({'alg': 'HS512'}, {'n': n, 'i': i}, 'secret'))
+
+
+class TestJWS_keyring(unittest.TestCase):
+    old = ecdsa.SigningKey.generate(ecdsa.NIST256p)
+    new = ecdsa.SigningKey.generate(ecdsa.NIST256p)
+
+    def ring(self, **options):
+        return jws.KeyRing({'old': self.old.get_verifying_key(), 'new': self.new.get_verifying_key()}, **options)
+
+    def test_rotation(self):
+        ring = self.ring()
+        ring.remove('old')
+        ring.add('old', self.old.get_verifying_key())
+        self.assertEqual([name for (name, _) in ring.candidates()], ['new', 'old'])
+        token = jws.encode({'alg': 'ES256'}, {'iss': 'a'}, self.old)
+        self.assertEqual(ring.decode(token), ({'alg': 'ES256'}, {'iss': 'a'}, 'old'))
+        # the match moves the old key first for that issuer only
+        self.assertEqual([name for (name, _) in ring.candidates('a')], ['old', 'new'])
+        self.assertEqual([name for (name, _) in ring.candidates('b')], ['new', 'old'])
+        for n in range(3):
+            token = jws.encode({'alg': 'ES256'}, {'iss': 'a', 'n': n}, self.new)
+            self.assertEqual(ring.decode(token)[2], 'new')
+        self.assertEqual([name for (name, _) in ring.candidates('a')], ['new', 'old'])
+        self.assertEqual(ring.matched, {'old': 1, 'new': 3})
+        header = {'alg': 'ES256'}
+        sig = jws.sign(header, 'payload', self.old)
+        self.assertEqual(ring.verify(header, 'payload', sig), 'old')
+
+    def test_header_processed_once(self):
+        ring = jws.KeyRing(['one', 'two', 'three'])
+        token = jws.encode({'alg': 'HS256'}, {'a': 1}, 'three')
+        calls = []
+        original = jws.header.process
+        jws.header.process = lambda *args: calls.append(args) or original(*args)
+        try:
+            self.assertEqual(ring.decode(token)[2], 2)
+        finally:
+            jws.header.process = original
+        self.assertEqual(len(calls), 1)
+
+    def test_no_match(self):
+        ring = self.ring()
+        other = ecdsa.SigningKey.generate(ecdsa.NIST256p)
+        token = jws.encode({'alg': 'ES256'}, {'a': 1}, other)
+        self.assertRaises(jws.SignatureError, ring.decode, token)
+        self.assertEqual(ring.matched, {})
+        self.assertRaises(jws.MissingKey, jws.KeyRing().decode, token)
+
+    def test_executor(self):
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(2) as executor:
+            ring = self.ring(executor=executor)
+            token = jws.encode({'alg': 'ES256'}, {'a': 1}, self.new)
+            self.assertEqual(ring.decode(token)[2], 'new')
+            token = jws.encode({'alg': 'ES256'}, {'a': 1}, ecdsa.SigningKey.generate(ecdsa.NIST256p))
+            self.assertRaises(jws.SignatureError, ring.decode, token)
+
+
+class TestJWS_batch(unittest.TestCase):
+    sk256 = ecdsa.SigningKey.generate(ecdsa.NIST256p)
+
+    def test_sign_many_verify_many(self):
+        header = {'alg': 'ES256'}
+        payloads = [{'n': n} for n in range(5)]
+        signed = list(jws.sign_many([(header, p) for p in payloads], self.sk256))
+        self.assertTrue(all(r.ok for r in signed))
+        tokens = [r.value for r in signed]
+        results = list(jws.verify_many(tokens, self.sk256.get_verifying_key()))
+        self.assertEqual([r.payload for r in results], payloads)
+        self.assertTrue(all(r.ok and r.value for r in results))
+
+    def test_verify_many_reports_errors_in_order(self):
+        header = {'alg': 'ES256'}
+        good = [r.value for r in jws.sign_many([(header, {'n': 1}), (header, {'n': 2})], self.sk256)]
+        (head, payload, sig) = good[1].split('.')
+        forged = '.'.join([head, jws.utils.encode({'n': 3}).decode('ascii'), sig])
+        tokens = [good[0], 'garbage', forged, good[1]]
+        results = list(jws.verify_many(tokens, self.sk256.get_verifying_key()))
+        self.assertEqual([r.ok for r in results], [True, False, False, True])
+        self.assertIsInstance(results[2].error, jws.SignatureError)
+        self.assertEqual(results[3].payload, {'n': 2})
+
+    def test_verify_many_resolves_key_once_per_header(self):
+        vk = self.sk256.get_verifying_key()
+        calls = []
+        def resolver(header):
+            calls.append(header)
+            return vk
+        items = [({'alg': 'ES256'}, {'n': n}) for n in range(3)]
+        items += [({'alg': 'ES256', 'typ': 'JWT'}, {'n': n}) for n in range(3)]
+        tokens = [r.value for r in jws.sign_many(items, self.sk256)]
+        results = list(jws.verify_many(tokens, resolver))
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(len(calls), 2)
+
+    def test_sign_many_bad_header(self):
+        results = list(jws.sign_many([({'alg': 'f7u12'}, {}), ({'alg': 'ES256'}, {})], self.sk256))
+        self.assertIsInstance(results[0].error, jws.AlgorithmNotImplemented)
+        self.assertTrue(results[1].ok)
+        self.assertTrue(jws.verify({'alg': 'ES256'}, {}, results[1].value.split('.')[2],
+                                   self.sk256.get_verifying_key()))
+
+    def test_group_errors_do_not_accumulate(self):
+        def depth(error):
+            (frames, tb) = (0, error.__traceback__)
+            while tb is not None:
+                (frames, tb) = (frames + 1, tb.tb_next)
+            return frames
+        tokens = [jws.encode({'alg': 'HS256'}, {'n': n}, 'secret') for n in range(50)]
+        results = list(jws.verify_many(tokens, lambda header: None))
+        self.assertIsInstance(results[-1].error, jws.MissingKey)
+        self.assertEqual(depth(results[-1].error), depth(results[1].error))
+        self.assertIsNot(results[-1].error, results[1].error)
+        results = list(jws.sign_many([({'alg': 'f7u12'}, {'n': n}) for n in range(50)], 'secret'))
+        self.assertEqual(depth(results[-1].error), depth(results[1].error))
+
+
+class TestJWS_parallel(unittest.TestCase):
+    sk256 = ecdsa.SigningKey.generate(ecdsa.NIST256p)
+
+    def tokens(self):
+        items = [({'alg': 'ES256'}, {'n': n}) for n in range(10)]
+        tokens = [r.value for r in jws.sign_many(items, self.sk256)]
+        tokens.insert(3, 'garbage')
+        return tokens
+
+    def check(self, results):
+        self.assertEqual(len(results), 11)
+        self.assertFalse(results[3].ok)
+        good = results[:3] + results[4:]
+        self.assertTrue(all(r.ok for r in good))
+        self.assertEqual([r.payload['n'] for r in good], list(range(10)))
+
+    def test_inline(self):
+        verifier = jws.Verifier(self.sk256.get_verifying_key(), chunk_size=4)
+        self.check(list(verifier.verify_many(self.tokens())))
+
+    def test_thread_pool(self):
+        with jws.Verifier(self.sk256.get_verifying_key(), executor='thread', workers=2, chunk_size=2) as verifier:
+            self.check(list(verifier.verify_many(self.tokens())))
+
+    def test_process_pool(self):
+        with jws.Verifier(self.sk256.get_verifying_key(), executor='process', workers=2, max_pending=2, chunk_size=3) as verifier:
+            self.check(list(verifier.verify_many(self.tokens())))
+            self.assertTrue(verifier.verify(self.tokens()[0]).ok)
+
+    def test_spawned_workers(self):
+        # spawned workers get their key pickled, which Crypto keys refuse
+        import multiprocessing
+        private = rsa.generate(2048)
+        tokens = [jws.encode({'alg': 'RS256'}, {'n': n}, private) for n in range(3)]
+        with jws.Verifier(private.publickey(), executor='process', workers=1,
+                          context=multiprocessing.get_context('spawn')) as verifier:
+            self.assertTrue(all(r.ok for r in verifier.verify_many(tokens)))
+
+    def test_backpressure(self):
+        consumed = []
+        def tokens():
+            for token in self.tokens():
+                consumed.append(token)
+                yield token
+        with jws.Verifier(self.sk256.get_verifying_key(), executor='thread', workers=1,
+                          max_pending=1, chunk_size=2) as verifier:
+            results = verifier.verify_many(tokens())
+            next(results)
+            self.assertTrue(len(consumed) <= 4)
+
+    def test_bad_executor(self):
+        self.assertRaises(ValueError, jws.Verifier, 'key', executor='gpu')
+
+    def test_process_pool_resolvers(self):
+        import json, os, shutil, tempfile
+        point = self.sk256.get_verifying_key().to_string()
+        b64 = lambda b: jws.utils.to_base64(b).decode('ascii')
+        jwks = {'keys': [{'kty': 'EC', 'crv': 'P-256', 'kid': 'ec', 'x': b64(point[:32]), 'y': b64(point[32:])}]}
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'jwks.json')
+            with open(path, 'w') as f:
+                json.dump(jwks, f)
+            tokens = [jws.encode({'alg': 'ES256', 'kid': 'ec'}, {'n': n}, self.sk256) for n in range(3)]
+            with jws.Verifier(jws.KeyStore.from_file(path), executor='process', workers=1) as verifier:
+                self.assertTrue(all(r.ok for r in verifier.verify_many(tokens)))
+        finally:
+            shutil.rmtree(directory)
+        for resolver in (jws.KeyStore(jwks), lambda header: self.sk256.get_verifying_key()):
+            self.assertRaises(TypeError, jws.Verifier, resolver, executor='process')
+            with jws.Verifier(resolver, executor='thread', workers=1) as verifier:
+                self.assertTrue(verifier.verify(tokens[0]).ok)
+
+
+class TestJWS_keystore(unittest.TestCase):
+    sk256 = ecdsa.SigningKey.generate(ecdsa.NIST256p)
+    private = rsa.generate(2048)
+
+    def ec_jwk(self, kid, sk):
+        point = sk.get_verifying_key().to_string()
+        half = len(point) // 2
+        b64 = lambda b: jws.utils.to_base64(b).decode('ascii')
+        return {'kty': 'EC', 'crv': 'P-256', 'kid': kid, 'x': b64(point[:half]), 'y': b64(point[half:]),
+                'd': b64(sk.to_string())}
+
+    def jwks(self):
+        b64 = lambda b: jws.utils.to_base64(b).decode('ascii')
+        n = self.private.n
+        return {'keys': [
+            self.ec_jwk('ec', self.sk256),
+            {'kty': 'oct', 'kid': 'hmac', 'alg': 'HS256', 'k': b64(b'secret')},
+            {'kty': 'RSA', 'kid': 'rsa', 'e': 'AQAB',
+             'n': b64(bytes(bytearray((n >> (8 * i)) & 0xff for i in reversed(range((n.bit_length() + 7) // 8)))))},
+        ]}
+
+    def test_rfc7638_thumbprint(self):
+        jwk = {'kty': 'RSA', 'e': 'AQAB', 'alg': 'RS256', 'kid': '2011-04-29',
+               'n': '0vx7agoebGcQSuuPiLJXZptN9nndrQmbXEps2aiAFbWhM78LhWx4cbbfAAtVT86zwu1RK7aPFFxuhDR1L6tSoc_BJECPebWKRXjBZCiFV4n3oknjhMstn64tZ_2W-5JsGY4Hc5n9yBXArwl93lqt7_RN5w6Cf0h4QyQ5v-65YGjQR0_FDW2QvzqY368QQMicAtaSqzs8KJZgnYb9c7d0zgdAZHzu6qMQvRL5hajrn1n91CbOpbISD08qNLyrdkt-bFTWhAI4vMQFh6WeZu0fM4lFd2NcRwr3XPksINHaQ-G_xBniIqbw0Ls1jF44-csFCur-kEgU8awapJzKnqDKgw'}
+        self.assertEqual(jws.keys.thumbprint(jwk), 'NzbLsXh8uDCcd-6MNwXF4W_7noWXFZAfHkxZsRGC9Xs')
+
+    def test_kid_picks_key(self):
+        store = jws.KeyStore(self.jwks())
+        for (alg, kid, key) in (('ES256', 'ec', None), ('HS256', 'hmac', None), ('RS256', 'rsa', self.private)):
+            header = {'alg': alg, 'kid': kid}
+            token = jws.encode(header, {'a': 1}, key, keystore=store)
+            self.assertEqual(jws.decode(token, keystore=store), (header, {'a': 1}))
+            (head, claim, sig) = token.split('.')
+            self.assertTrue(jws.verify(header, {'a': 1}, sig, keystore=store))
+        self.assertRaises(jws.MissingKey, jws.decode, token.replace(token.split('.')[0],
+                          jws.utils.encode({'alg': 'RS256', 'kid': 'nope'}).decode('ascii')), keystore=store)
+
+    def test_store_as_resolver(self):
+        store = jws.KeyStore(self.jwks())
+        tokens = [jws.encode({'alg': 'ES256', 'kid': 'ec'}, {'n': n}, self.sk256) for n in range(3)]
+        self.assertTrue(all(r.ok for r in jws.verify_many(tokens, store)))
+        ec = self.jwks()['keys'][0]
+        self.assertIs(store.find(jws.keys.thumbprint(ec)), store.get('ec'))
+        self.assertIs(store.get(jws.keys.thumbprint(ec)), store.get('ec'))
+
+    def test_warm_store(self):
+        store = jws.KeyStore(self.jwks(), warm=True)
+        public = store.get('ec')
+        self.assertIsNot(jws.algos.route('ES256')['prepare_key'](public), public)
+        token = jws.encode({'alg': 'ES256', 'kid': 'ec'}, {'a': 1}, self.sk256)
+        self.assertEqual(jws.decode(token, keystore=store)[1], {'a': 1})
+
+    def reloaded(self, store):
+        # a lookup starts a check in the background; wait for it
+        store.get(None)
+        if store._reloader is not None:
+            store._reloader.join()
+        return store
+
+    def test_add_and_reload(self):
+        import json, os, shutil, tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'jwks.json')
+            with open(path, 'w') as f:
+                json.dump({'keys': [self.ec_jwk('one', self.sk256)]}, f)
+            store = jws.KeyStore.from_file(path, reload_interval=0)
+            self.assertTrue(store.get('one') is not None)
+            other = ecdsa.SigningKey.generate(ecdsa.NIST256p)
+            with open(path, 'w') as f:
+                json.dump({'keys': [self.ec_jwk('two', other)]}, f)
+            os.utime(path, (0, 0))
+            self.reloaded(store)
+            self.assertEqual(store.get('one'), None)
+            self.assertEqual(store.get('two').to_string(), other.get_verifying_key().to_string())
+            store.add(self.sk256.get_verifying_key(), kid='three', private_key=self.sk256)
+            self.assertIs(store.get('three', private=True), self.sk256)
+            # a half written file, then none at all: the keys stay
+            with open(path, 'w') as f:
+                f.write('{"keys": [')
+            os.utime(path, (1, 1))
+            self.assertIs(self.reloaded(store).get('three', private=True), self.sk256)
+            self.assertTrue(isinstance(store.reload_error, ValueError))
+            os.remove(path)
+            self.assertTrue(self.reloaded(store).get('two') is not None)
+            self.assertTrue(isinstance(store.reload_error, (IOError, OSError)))
+            with open(path, 'w') as f:
+                json.dump({'keys': [self.ec_jwk('one', self.sk256)]}, f)
+            self.assertTrue(self.reloaded(store).get('one') is not None)
+            self.assertEqual(store.reload_error, None)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_reload_does_not_block_readers(self):
+        import json, os, shutil, tempfile, threading
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'jwks.json')
+            with open(path, 'w') as f:
+                json.dump({'keys': [self.ec_jwk('one', self.sk256)]}, f)
+            store = jws.KeyStore.from_file(path, reload_interval=0, warm=True)
+            with open(path, 'w') as f:
+                json.dump({'keys': [self.ec_jwk('two', self.sk256)]}, f)
+            os.utime(path, (0, 0))
+            (started, proceed) = (threading.Event(), threading.Event())
+            warm = store._warm
+            def slow(entries):
+                started.set()
+                proceed.wait()
+                warm(entries)
+            store._warm = slow
+            # the reader gets the old key while the reload is held up
+            self.assertTrue(store.get('one') is not None)
+            started.wait()
+            self.assertTrue(store.get('one') is not None)
+            proceed.set()
+            store._reloader.join()
+            self.assertTrue(store.get('two') is not None)
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestJWS_cache(unittest.TestCase):
+    sk256 = ecdsa.SigningKey.generate(ecdsa.NIST256p)
+    vk256 = sk256.get_verifying_key()
+
+    def test_hit_skips_crypto(self):
+        cache = jws.VerificationCache()
+        token = jws.encode({'alg': 'ES256'}, {'n': 1}, self.sk256)
+        self.assertEqual(jws.decode(token, self.vk256, cache=cache), ({'alg': 'ES256'}, {'n': 1}))
+        calls = []
+        original = jws.algos.ECDSA.verify
+        jws.algos.ECDSA.verify = lambda *args: calls.append(args)
+        try:
+            jws.algos.clear_route_cache()
+            self.assertEqual(jws.decode(token, self.vk256, cache=cache), ({'alg': 'ES256'}, {'n': 1}))
+            sig = token.split('.')[2]
+            self.assertTrue(jws.verify({'alg': 'ES256'}, {'n': 1}, sig, self.vk256, cache=cache))
+        finally:
+            jws.algos.ECDSA.verify = original
+            jws.algos.clear_route_cache()
+        self.assertEqual(calls, [])
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (2, 1, 1))
+
+    def test_failures_and_other_keys_are_not_cached(self):
+        cache = jws.VerificationCache()
+        token = jws.encode({'alg': 'ES256'}, {'n': 1}, self.sk256)
+        other = ecdsa.SigningKey.generate(ecdsa.NIST256p).get_verifying_key()
+        self.assertRaises(jws.SignatureError, jws.decode, token, other, cache=cache)
+        self.assertEqual(len(cache), 0)
+        jws.decode(token, self.vk256, cache=cache)
+        self.assertRaises(jws.SignatureError, jws.decode, token, other, cache=cache)
+        forged = token[:-4] + ('AAAA' if token[-4:] != 'AAAA' else 'BBBB')
+        self.assertRaises(jws.SignatureError, jws.decode, forged, self.vk256, cache=cache)
+
+    def test_expiry_and_bounds(self):
+        import time
+        cache = jws.VerificationCache(ttl=60)
+        token = jws.encode({'alg': 'HS256'}, {'exp': time.time() - 1}, 'secret')
+        jws.decode(token, 'secret', cache=cache)
+        self.assertEqual(cache.get(*token.rsplit('.', 1) + ['secret']), None)
+        self.assertEqual(cache.expired, 1)
+
+        cache = jws.VerificationCache(maxsize=2)
+        for n in range(3):
+            jws.decode(jws.encode({'alg': 'HS256'}, {'n': n}, 'secret'), 'secret', cache=cache)
+        self.assertEqual((len(cache), cache.evictions), (2, 1))
+
+        cache = jws.VerificationCache(maxbytes=3 * (32 + 100 + jws.cache.ENTRY_OVERHEAD))
+        for n in range(10):
+            jws.decode(jws.encode({'alg': 'HS256'}, {'n': n}, 'secret'), 'secret', cache=cache)
+        self.assertTrue(len(cache) <= 3)
+        self.assertTrue(cache.stats()['bytes'] <= cache._entries.maxbytes)
+
+class TestJWS_metrics(unittest.TestCase):
+    sk256 = ecdsa.SigningKey.generate(ecdsa.NIST256p)
+
+    def test_events(self):
+        events = []
+        vk = self.sk256.get_verifying_key()
+        with jws.metrics.recording(events.append):
+            token = jws.encode({'alg': 'ES256'}, {'n': 1}, self.sk256)
+            self.assertEqual(jws.decode(token, vk), ({'alg': 'ES256'}, {'n': 1}))
+            signature = jws.sign('{"alg": "HS256"}', '{"n": 1}', 'secret', is_json=True)
+            self.assertEqual(signature, jws.utils.to_base64(jws.algos.route('HS256')['sign'](
+                jws.utils.to_base64('{"alg": "HS256"}') + b'.' + jws.utils.to_base64('{"n": 1}'), 'secret')))
+            self.assertTrue(jws.verify({'alg': 'HS256'}, {'n': 1}, jws.sign({'alg': 'HS256'}, {'n': 1}, 'secret'), 'secret'))
+            other = ecdsa.SigningKey.generate(ecdsa.NIST256p).get_verifying_key()
+            self.assertRaises(jws.SignatureError, jws.decode, token, other)
+            self.assertRaises(jws.MissingKey, jws.decode, token)
+        jws.decode(token, vk)
+        self.assertEqual([(e.op, e.alg, e.outcome) for e in events], [
+            ('encode', 'ES256', 'ok'), ('decode', 'ES256', 'ok'), ('sign', 'HS256', 'ok'),
+            ('sign', 'HS256', 'ok'), ('verify', 'HS256', 'ok'),
+            ('decode', 'ES256', 'SignatureError'), ('decode', 'ES256', 'MissingKey')])
+        self.assertEqual(sorted(events[1].stages), ['crypto', 'decode', 'header', 'split'])
+        self.assertEqual(sorted(events[2].stages), ['crypto', 'encode', 'header'])
+        self.assertTrue(events[1].duration >= sum(events[1].stages.values()))
+        self.assertEqual(jws.metrics.HOOKS, ())
+
+    def test_same_with_and_without_hooks(self):
+        import time
+        vk = self.sk256.get_verifying_key()
+        # a payload that expired a moment ago, given as JSON text
+        head = '{"alg": "HS256"}'
+        payload = '{"exp": %d}' % (time.time() - 10)
+        def calls():
+            cache = jws.VerificationCache()
+            signature = jws.sign(head, payload, 'secret', is_json=True)
+            verified = [jws.verify(head, payload, signature, 'secret', is_json=True, cache=cache) for _ in range(2)]
+            token = jws.encode({'alg': 'ES256'}, {'n': 1}, self.sk256)
+            return (signature, verified, cache.stats(), jws.decode(token, vk), jws.encode({'alg': 'HS256'}, 'x', 'secret'))
+        plain = calls()
+        events = []
+        with jws.metrics.recording(events.append):
+            hooked = calls()
+        self.assertEqual(len(events), 6)
+        # the cache saw the exp both times, and let the entry lapse
+        self.assertEqual(plain[2]['expired'], 1)
+        self.assertEqual(plain, hooked)
+
+    def test_histograms(self):
+        histograms = jws.metrics.Histograms(buckets=(0.5, 0.001))
+        for (outcome, seconds) in (('ok', 0.0001), ('ok', 0.01), ('SignatureError', 2.0)):
+            histograms(jws.metrics.Event('verify', 'HS256', outcome, seconds, {'crypto': seconds}))
+        calls = dict((c['outcome'], c) for c in histograms.snapshot()['calls'])
+        self.assertEqual(calls['ok']['count'], 2)
+        self.assertEqual(calls['ok']['buckets'], [[0.001, 1], [0.5, 2], ['+Inf', 2]])
+        self.assertEqual(calls['SignatureError']['buckets'], [[0.001, 0], [0.5, 0], ['+Inf', 1]])
+        (stage,) = histograms.snapshot()['stages']
+        self.assertEqual((stage['stage'], stage['count']), ('crypto', 3))
+        histograms.reset()
+        self.assertEqual(histograms.snapshot(), {'calls': [], 'stages': []})
+
+
+class TestJWS_aio(unittest.TestCase):
+    sk256 = ecdsa.SigningKey.generate(ecdsa.NIST256p)
+
+    def run_async(self, coroutine):
+        import asyncio
+        return asyncio.run(coroutine)
+
+    def test_sign_verify_decode(self):
+        import jws.aio
+        vk = self.sk256.get_verifying_key()
+        for (header, key, vkey) in (({'alg': 'ES256'}, self.sk256, vk), ({'alg': 'HS256'}, 'secret', 'secret')):
+            sig = self.run_async(jws.aio.sign(header, {'a': 1}, key))
+            self.assertTrue(jws.verify(header, {'a': 1}, sig, vkey))
+            self.assertTrue(self.run_async(jws.aio.verify(header, {'a': 1}, sig, vkey)))
+            token = jws.encode(header, {'a': 1}, key)
+            self.assertEqual(self.run_async(jws.aio.decode(token, vkey)), (header, {'a': 1}))
+            self.assertRaises(jws.SignatureError, self.run_async, jws.aio.verify(header, {'a': 2}, sig, vkey))
+
+    def test_keyword_arguments(self):
+        import jws.aio
+        header = {'alg': 'HS256'}
+        sig = jws.sign(header, {'a': 1}, 'secret')
+        cache = jws.VerificationCache()
+        for _ in range(2):
+            self.assertTrue(self.run_async(jws.aio.verify(header, {'a': 1}, sig, 'secret', cache=cache)))
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (1, 1, 1))
+        token = jws.encode(header, {'a': 1}, 'secret')
+        cache = jws.VerificationCache()
+        for _ in range(2):
+            self.run_async(jws.aio.decode(token, 'secret', cache=cache))
+        self.assertEqual((cache.hits, len(cache)), (1, 1))
+        policy = jws.Policy(algorithms=['ES256'])
+        self.assertRaises(jws.AlgorithmNotAllowed, self.run_async, jws.aio.decode(token, 'secret', policy=policy))
+        self.assertEqual(self.run_async(jws.aio.sign('{"alg": "HS256"}', '{"a": 1}', 'secret', is_json=True)),
+                         jws.sign('{"alg": "HS256"}', '{"a": 1}', 'secret', is_json=True))
+        self.assertRaises(TypeError, jws.aio.verify, header, {'a': 1}, sig, 'secret', cahce=cache)
+        self.assertRaises(TypeError, jws.aio.sign, header, {'a': 1}, 'secret', nope=True)
+
+    def test_process_executor(self):
+        import jws.aio
+        from concurrent.futures import ProcessPoolExecutor
+        token = jws.encode({'alg': 'ES256'}, {'a': 1}, self.sk256)
+        private = rsa.generate(2048)
+        with ProcessPoolExecutor(1) as executor:
+            decoded = self.run_async(jws.aio.decode(token, self.sk256.get_verifying_key(), executor=executor))
+            # Crypto keys do not pickle
+            sig = self.run_async(jws.aio.sign({'alg': 'RS256'}, {'a': 1}, private, executor=executor))
+            rs256 = self.run_async(jws.aio.decode(jws.encode({'alg': 'RS256'}, {'a': 1}, private),
+                                                  private.publickey(), executor=executor))
+        self.assertEqual(decoded[1], {'a': 1})
+        self.assertTrue(jws.verify({'alg': 'RS256'}, {'a': 1}, sig, private.publickey()))
+        self.assertEqual(rs256[1], {'a': 1})
+
+    def test_concurrent_identical_tokens_coalesce(self):
+        import asyncio
+        import jws.aio
+        calls = []
+        verify = jws.aio._verify_input
+        def counting(*args):
+            calls.append(args)
+            return verify(*args)
+        token = jws.encode({'alg': 'ES256'}, {'a': 1}, self.sk256)
+        other = jws.encode({'alg': 'ES256'}, {'a': 2}, self.sk256)
+        vk = self.sk256.get_verifying_key()
+        async def many():
+            return await asyncio.gather(*[jws.aio.decode(t, vk) for t in [token] * 5 + [other]])
+        jws.aio._verify_input = counting
+        try:
+            results = self.run_async(many())
+        finally:
+            jws.aio._verify_input = verify
+        self.assertEqual([r[1]['a'] for r in results], [1] * 5 + [2])
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(jws.aio._inflight, {})
+
+    def test_verify_many(self):
+        import jws.aio
+        tokens = [jws.encode({'alg': 'ES256'}, {'n': n}, self.sk256) for n in range(5)] + ['garbage']
+        results = self.run_async(jws.aio.verify_many(tokens, self.sk256.get_verifying_key(), chunk_size=2))
+        self.assertEqual([r.ok for r in results], [True] * 5 + [False])
+        self.assertEqual([r.payload['n'] for r in results[:5]], list(range(5)))
+
+
 class TestJWS_hmac(unittest.TestCase):
     def setUp(self):
         self.payload = {
@@ -139,10 +1185,35 @@ class TestJWS_hmac(unittest.TestCase):
         self.assertTrue(len(sig) > 0)
         self.assertTrue(jws.verify(header, self.payload, sig, 'secret'))
 
+    def test_hmac_key(self):
+        header = {'alg': 'HS256'}
+        key = jws.algos.HMACKey('secret', 256)
+        sig = jws.sign(header, self.payload, key)
+        self.assertEqual(sig, jws.sign(header, self.payload, 'secret'))
+        self.assertTrue(jws.verify(header, self.payload, sig, key))
+        self.assertRaises(jws.SignatureError, jws.verify, header, self.payload, sig, jws.algos.HMACKey('nope', 256))
+        # a key prepared for another size still works, through its secret
+        sig512 = jws.sign({'alg': 'HS512'}, self.payload, key)
+        self.assertEqual(sig512, jws.sign({'alg': 'HS512'}, self.payload, 'secret'))
+        token = jws.encode(header, self.payload, key)
+        self.assertEqual(jws.decode(token, key)[1], self.payload)
+        self.assertTrue(all(r.ok for r in jws.verify_many([token, token], key)))
+        self.assertEqual(jws.Signer(header, key).feed([b'abc']).finalize(),
+                         jws.Signer(header, 'secret').feed([b'abc']).finalize())
+
+    def test_hmac_key_pickles(self):
+        import pickle
+        key = pickle.loads(pickle.dumps(jws.algos.HMACKey(b'secret', 384)))
+        self.assertEqual((key.secret, key.bits), (b'secret', 384))
+        self.assertEqual(jws.algos.key_fingerprint(key), jws.algos.key_fingerprint('secret'))
+        token = jws.encode({'alg': 'HS384'}, self.payload, 'secret')
+        with jws.Verifier(key, executor='process', workers=1) as verifier:
+            self.assertTrue(verifier.verify(token).ok)
+
     def test_invalid_hmac(self):
         header = {'alg': 'HS512'}
         sig = jws.sign(header, self.payload, 'secret')
-        self.assertRaises(jws.SignatureError(header, self.payload, sig, 'failwhale'))
+        self.assertRaises(jws.SignatureError, jws.verify, header, self.payload, sig, 'failwhale')
 
 class TestJWS_rsa(unittest.TestCase):
     private = rsa.generate(2048)
@@ -173,6 +1244,34 @@ class TestJWS_rsa(unittest.TestCase):
         self.assertTrue(len(sig) > 0)
         self.assertTrue(jws.verify(header, self.payload, sig, public))
 
+    def test_valid_rsa_string_keys(self):
+        header = {'alg': 'RS256'}
+        sig = jws.sign(header, self.payload, self.private.exportKey())
+        public = self.private.publickey().exportKey()
+        self.assertTrue(jws.verify(header, self.payload, sig, public))
+        self.assertTrue(jws.verify(header, self.payload, sig, public))
+        self.assertRaises(jws.SignatureError, jws.verify, header, {'bad': 1}, sig, public)
+
+    def test_shared_instance_is_thread_safe(self):
+        import threading
+        public = self.private.publickey()
+        errors = []
+        def hammer(alg, n):
+            crypt = jws.algos.route(alg)
+            try:
+                for i in range(10):
+                    msg = 'message %d from thread %d' % (i, n)
+                    sig = crypt['sign'](msg, self.private)
+                    crypt['verify'](msg, sig, public)
+                    self.assertRaises(jws.SignatureError, crypt['verify'], msg + '!', sig, public)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=hammer, args=(alg, n))
+                   for alg in ('RS256', 'PS384') for n in range(8)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(errors, [])
+
     def test_valid_rsa256_pss(self):
         header = {'alg': 'PS256'}
         sig = jws.sign(header, self.payload, self.private)
@@ -2,6 +2,8 @@ from __future__ import unicode_literals
 
 import base64
 import json
+import threading
+from collections import OrderedDict
 
 import sys
 if sys.version < '3':
@@ -12,39 +14,147 @@ else:
     binary_type = bytes
 
 def to_bytes_2and3(s):
-    if type(s) != binary_type:
-        s = bytes(s, 'UTF-8')
-    return s
+    """
+    Encode text as UTF-8. Bytes and other buffers (``bytearray``,
+    ``memoryview``) are returned as they are, without a copy.
+    """
+    if isinstance(s, (binary_type, bytearray, memoryview)):
+        return s
+    return s.encode('UTF-8')
 
 def base64url_decode(input):
     input = to_bytes_2and3(input)
-    input += b'=' * (4 - (len(input) % 4))
+    padding = b'=' * (-len(input) % 4)
+    if padding or not isinstance(input, binary_type):
+        # one copy, which also turns a buffer into bytes
+        input = b''.join((input, padding))
     return base64.urlsafe_b64decode(input)
 def base64url_encode(input):
-    return base64.urlsafe_b64encode(to_bytes_2and3(input)).replace(b'=', b'')
+    # rstrip only copies when there is padding to remove
+    return base64.urlsafe_b64encode(to_bytes_2and3(input)).rstrip(b'=')
+
+# JSON codecs by name, as ``(dumps, loads)`` pairs. ``dumps`` may return text
+# or bytes. The default is the stdlib with its default settings, which is what
+# existing signatures were made over; a faster codec that serializes
+# differently makes different (still valid) signatures.
+CODECS = {'json': (json.dumps, json.loads)}
+DEFAULT_CODEC = 'json'
+
+def register_codec(name, dumps, loads):
+    """Make a ``(dumps, loads)`` pair available as ``codec=name``."""
+    CODECS[name] = (dumps, loads)
+
+def set_codec(name):
+    """Use the codec registered as ``name`` wherever no codec is given."""
+    global DEFAULT_CODEC
+    if name not in CODECS:
+        raise KeyError("No JSON codec registered as %r" % (name,))
+    DEFAULT_CODEC = name
 
-def to_json(a): return json.dumps(a)
-def from_json(a): return json.loads(a)
+def get_codec(codec=None):
+    """
+    Resolve ``codec`` -- a registered name, a ``(dumps, loads)`` pair or None
+    for the process-wide default -- to a ``(dumps, loads)`` pair.
+    """
+    if codec is None:
+        codec = DEFAULT_CODEC
+    if isinstance(codec, tuple):
+        return codec
+    return CODECS[codec]
+
+def to_json(a, codec=None): return get_codec(codec)[0](a)
+def from_json(a, codec=None): return get_codec(codec)[1](a)
 def to_base64(a): return base64url_encode(a)
 def from_base64(a): return base64url_decode(a)
-def encode(a): return to_base64(to_json(a))
-def decode(a): return from_json(from_base64(a))
+# the json text is converted before base64 so it can be freed early
+def encode(a, codec=None): return to_base64(to_bytes_2and3(to_json(a, codec)))
+def decode(a, codec=None): return from_json(from_base64(a), codec)
+
+class LRUCache(object):
+    """
+    A small thread-safe least-recently-used mapping. ``maxsize`` bounds the
+    number of entries and, if given, ``maxbytes`` bounds the total of
+    ``sizeof(key, value)`` over the entries. Hit, miss and eviction counts are
+    kept for inspection.
+    """
+    def __init__(self, maxsize=128, maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(key, value) if self.sizeof else 0
+        with self._lock:
+            self._remove(key)
+            if self.maxbytes is not None and size > self.maxbytes:
+                return
+            self._data[key] = value
+            self.size += size
+            while len(self._data) > self.maxsize or (self.maxbytes is not None and self.size > self.maxbytes):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key, default)
+            self._remove(key)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        if key in self._data:
+            value = self._data.pop(key)
+            if self.sizeof:
+                self.size -= self.sizeof(key, value)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
 
-#Taken from Django Source Code
+try:
+    from hmac import compare_digest as _compare_digest
+except ImportError: # python < 2.7.7
+    def _compare_digest(val1, val2):
+        if len(val1) != len(val2):
+            return False
+        result = 0
+        for x, y in zip(bytearray(val1), bytearray(val2)):
+            result |= x ^ y
+        return result == 0
 
 def constant_time_compare(val1, val2):
     """
     Returns True if the two strings are equal, False otherwise.
 
     The time taken is independent of the number of characters that match.
+    Text is compared by its UTF-8 encoding, so str and bytes can be mixed.
+    The comparison itself is ``hmac.compare_digest``, which runs in C.
 
     For the sake of simplicity, this function executes in constant time only
     when the two strings have the same length. It short-circuits when they
     have different lengths.
     """
-    if len(val1) != len(val2):
-        return False
-    result = 0
-    for x, y in zip(val1, val2):
-        result |= ord(x) ^ ord(y)
-    return result == 0
+    return _compare_digest(to_bytes_2and3(val1), to_bytes_2and3(val2))
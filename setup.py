@@ -14,6 +14,7 @@ setup(
     keywords = "jws json web security signing",
     url = "http://github.com/brianlovesdata/python-jws",
     packages=['jws'],
+    entry_points={'console_scripts': ['jws = jws.cli:main']},
     long_description=read('README.md'),
     classifiers=[
         "Development Status :: 3 - Alpha",